@@ -1,9 +1,24 @@
 #!/usr/bin/python
 """
-Usage: convertFlac [options] [-o PATH] <SOURCES> ...
+Usage: convertFlac bench [options]
+       convertFlac watch [options] [--profile=SPEC]... [-o PATH] <SOURCES> ...
+       convertFlac coordinator --broker=DB [options] [-o PATH] <SOURCES> ...
+       convertFlac worker --broker=DB [options]
+       convertFlac --from-plan=FILE [options]
+       convertFlac [options] [--profile=SPEC]... [-o PATH] <SOURCES> ...
 
 accepts flac files or directories, creating VO mp3 files from each flac.
 
+"convertFlac bench" converts a generated corpus of flac files with each combination
+of --bench-cores and --bench-settings and reports the throughput of each.
+
+"convertFlac watch" converts the given folders, then keeps running and converts
+flac files as they are added to them, once they have stopped growing.
+
+"convertFlac coordinator" publishes a conversion as jobs in a shared queue, which
+"convertFlac worker" processes on any number of hosts, and reports the throughput of
+each worker once they are done.
+
 Options:
   -h, --help             show this help message and exit
 
@@ -14,10 +29,76 @@ Options:
 
   --num-cores=N          defines the number of processing cores to use for concurrent
                          conversions. Defaults to using half of available cores. Also
-                         accepts 'MAX' as an argument to use all availabe cores.
+                         accepts 'MAX' as an argument to use all availabe cores, or
+                         'AUTO' to start new conversions whenever there is idle cpu.
+
+  --tagger=NAME          how tags are written to the mp3s. "lame" passes the flac's
+                         tags and front cover to lame so they are written along with
+                         the audio, "mutagen" adds the tags to the finished mp3
+                         [default: lame].
+
+  --metrics=DEST         write a json line of timings, sizes and exit codes for each
+                         conversion to DEST, followed by a summary. DEST is a file,
+                         "tcp://HOST:PORT" or "unix:PATH". Prints a summary of timing
+                         percentiles at the end of the run.
+
+  --order=ORDER          order to convert files in. "discovery" starts converting as
+                         soon as the first flac is found, "largest" converts the
+                         longest tracks first so a long track doesn't hold up the end
+                         of a batch [default: discovery].
 
   --nice=N               Set process nice level for encoding/decoding [default: 10].
 
+  --split=SECONDS        encode mp3s of flacs longer than SECONDS as chunks of about
+                         SECONDS in parallel, joined into one gapless mp3. Meant
+                         for long single-file rips. Disables lame's bit reservoir
+                         for those files.
+
+  --cue                  split flac images with a cue sheet (a .cue file with the same
+                         name, or one embedded in the flac) into an mp3 per track,
+                         named "NN - TITLE.mp3" and tagged from the cue sheet. The
+                         tracks of an image are encoded in parallel, each decoded
+                         from its range of the image straight into lame.
+
+  --read-ahead=MB        read flacs into memory ahead of converting them, holding up
+                         to MB megabytes at a time, so the source disks are read
+                         sequentially by --max-readers threads rather than by every
+                         conversion at once. Each flac counts twice, as it is held
+                         both by its reader and by the process converting it.
+
+  --max-readers=N        number of flacs read ahead at the same time [default: 1].
+
+  --max-writers=N        number of mp3s written to the output at the same time. mp3s
+                         are encoded to a local temporary folder and moved into place
+                         by N threads.
+
+  --preflight            check the headers of every flac before converting any, and
+                         print a report of the bad files, which are skipped, and of
+                         the total length of the rest. Conversions then print an
+                         estimate of the time left.
+
+  --plan=FILE            work out what converting SOURCES would do, without converting
+                         or writing anything but FILE: the outputs, collisions
+                         between them, and the output size and encoding time,
+                         estimated from a short test encode. The plan is written to
+                         FILE as json.
+
+  --from-plan=FILE       convert the files in a plan written by --plan, with the lame
+                         settings or profiles it was made with, instead of searching
+                         the sources again.
+
+  --art-size=PIXELS      scale cover art larger than PIXELS on its longest side down
+                         to fit before embedding it, re-encoded as a jpeg. Requires
+                         the Pillow package, art is embedded as is without it.
+
+  --art-max-kb=KB        leave out cover art that is still larger than KB kilobytes
+                         after scaling.
+
+  --decoder=NAME         flac decoder to use, either "flac" to pipe the flac binary
+                         into lame or "soundfile" to decode in-process with
+                         libsndfile (requires the soundfile package, falls back to
+                         flac for files it cannot read) [default: flac].
+
   Directory Options:
     These options are used for determining behavior when being passed a
     directory
@@ -37,12 +118,37 @@ Options:
     --replace PAT       A sed type regex substitution string to be run on each
                         directory and file name (remember to escape regex control chars.)
 
+    --link=MODE         how cloned files are copied. "copy" copies them, "reflink"
+                        makes copy-on-write clones where the filesystem supports it
+                        and "hardlink" links them (edits then affect both copies).
+                        Falls back to copying across filesystems [default: copy].
+
+    --io-workers=N      number of threads copying cloned files while the flacs are
+                        converted [default: 4].
+
     --delete-flacs      delete input flacs after transcode. Cleans up empty directories
                         as well. (use without "-c" or "-o" to simulate an inplace
                         transcode).
 
     -f, --overwrite     forces overwriting if files already exist.
 
+    --dedup             encode audio-identical flacs (same STREAMINFO md5) only once.
+                        The mp3 is hardlinked, or copied and retagged, to the other
+                        destinations.
+
+    --resume            resume an interrupted conversion. Partial mp3s it left in the
+                        output or cloned folders are removed and already cloned
+                        folders are reused. Finished mp3s are skipped as usual.
+
+    --index=DB          cache directory listings in the sqlite file DB. Folders whose
+                        modification time hasn't changed since the last run are not
+                        listed again.
+
+    --manifest=DB       keep a record of completed conversions in the sqlite file DB
+                        (eg: "OUTPUT/.convertFlac.db"). Sources whose size, mtime and
+                        content hash, and lame settings, match the record are skipped
+                        on later runs. Outputs missing from the record are re-encoded.
+
   Custom Lame Settings:
     Options for customizing the settings lame will use to convert the flac
     files. Defaults to V0.
@@ -55,30 +161,273 @@ Options:
                              encoder. Type "lame -h" to see lame options. Overrides
                              other lame settings. Be sure to encapsulate options
                              with quotes ex: "-p -V2 -a"
+
+    --profile=SPEC           An output format, as "NAME=ENCODER [ARGS]", where
+                             ENCODER is lame or opusenc. Can be given several times,
+                             ex: --profile "V0=lame -V0" --profile "OPUS=opusenc
+                             --bitrate 160". Each flac is decoded once and fed to
+                             every profile's encoder. With several profiles, each one
+                             is written to OUTPUT/NAME, or to cloned folders suffixed
+                             with " [NAME]". Overrides other lame settings.
+
+  Watch Options:
+    Options for "convertFlac watch". Folders are watched with inotify where it is
+    available, otherwise they are polled.
+
+    --settle=SECONDS         how long a new file has to stay the same size before it
+                             is converted [default: 5].
+
+    --poll                   poll the folders for new files instead of using inotify.
+
+    --poll-interval=SECONDS  how often to check for new files [default: 2].
+
+  Distributed Options:
+    Options for "convertFlac coordinator" and "convertFlac worker". Sources and outputs
+    must be on shared storage, at the same paths on every host. Profiles, manifests and
+    deduplication are not supported.
+
+    --broker=DB              sqlite job queue shared by the coordinator and its
+                             workers, on storage that every host can reach.
+
+    --lease=SECONDS          how long a worker holds a job before it may be given to
+                             another worker. Renewed while the job runs
+                             [default: 300].
+
+    --retries=N              how many times a failed job is retried [default: 2].
+
+    --worker-name=NAME       name to report a worker's throughput under. Defaults to
+                             HOST:PID.
+
+  Benchmark Options:
+    Options for "convertFlac bench". The corpus is generated with the flac binary and
+    reused by later benchmarks with the same corpus options.
+
+    --corpus=DIR             folder for the synthetic corpus
+                             [default: convertFlac-bench-corpus].
+
+    --corpus-files=N         number of flac files in the corpus [default: 20].
+
+    --corpus-length=SECONDS  length of each flac file [default: 30].
+
+    --corpus-tags=N          number of extra tags on each flac file [default: 10].
+
+    --corpus-signal=TYPE     audio to generate, "sine" or "noise" [default: noise].
+
+    --bench-cores=LIST       comma separated core counts to benchmark [default: 1,2].
+
+    --bench-settings=LIST    comma separated lame settings to benchmark
+                             [default: -V0].
+
+    --bench-json=FILE        write the results as json to FILE instead of printing
+                             them after the table.
+
+    --bench-paths=N          instead of converting, time mapping N generated flac
+                             paths to output paths, one at a time with
+                             get_output_path() and with one shared PathMapper.
 """
 from __future__ import unicode_literals, print_function
 
 __author__ = 'Laharah'
 
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
 from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+import collections
 import contextlib
+import ctypes
+import ctypes.util
+import errno
 import functools
+import array
+import asyncio
+import hashlib
+import io
+import json
+import math
+import multiprocessing
 import os
 from multiprocessing import cpu_count
+import random
 import re
+import select
+import signal
 import sys
 import shutil
+import socket
+import sqlite3
+import struct
 import subprocess
 import tempfile
 import threading
+import time
 import warnings
+import wave
 import queue
 
 from mutagen import MutagenError
-from mutagen import File as mutagenFile
 from mutagen.flac import FLAC
+from mutagen.flac import CueSheet
+from mutagen.flac import VCFLACDict
 from mutagen.easyid3 import EasyID3
 from mutagen.easyid3 import EasyID3KeyError
+from mutagen.id3 import APIC
+from mutagen.id3 import ID3
+from mutagen.id3 import delete as delete_id3
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+# linux ioctl to make a copy-on-write clone of a file (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# flac vorbis comments and the id3v2 frames lame should write them to, mirroring the
+# keys EasyID3 supports. "TXXX=desc" frames are user defined text frames.
+ID3_FRAMES = {
+    'album': 'TALB',
+    'bpm': 'TBPM',
+    'compilation': 'TCMP',
+    'composer': 'TCOM',
+    'copyright': 'TCOP',
+    'encodedby': 'TENC',
+    'lyricist': 'TEXT',
+    'length': 'TLEN',
+    'media': 'TMED',
+    'mood': 'TMOO',
+    'grouping': 'TIT1',
+    'title': 'TIT2',
+    'version': 'TIT3',
+    'artist': 'TPE1',
+    'albumartist': 'TPE2',
+    'conductor': 'TPE3',
+    'arranger': 'TPE4',
+    'discnumber': 'TPOS',
+    'organization': 'TPUB',
+    'tracknumber': 'TRCK',
+    'author': 'TOLY',
+    'albumartistsort': 'TSO2',
+    'albumsort': 'TSOA',
+    'composersort': 'TSOC',
+    'artistsort': 'TSOP',
+    'titlesort': 'TSOT',
+    'isrc': 'TSRC',
+    'discsubtitle': 'TSST',
+    'language': 'TLAN',
+    'genre': 'TCON',
+    'date': 'TDRC',
+    'originaldate': 'TDOR',
+    'website': 'WOAR',
+    'musicbrainz_artistid': 'TXXX=MusicBrainz Artist Id',
+    'musicbrainz_albumid': 'TXXX=MusicBrainz Album Id',
+    'musicbrainz_albumartistid': 'TXXX=MusicBrainz Album Artist Id',
+    'musicbrainz_trmid': 'TXXX=MusicBrainz TRM Id',
+    'musicip_puid': 'TXXX=MusicIP PUID',
+    'musicip_fingerprint': 'TXXX=MusicMagic Fingerprint',
+    'musicbrainz_albumstatus': 'TXXX=MusicBrainz Album Status',
+    'musicbrainz_albumtype': 'TXXX=MusicBrainz Album Type',
+    'releasecountry': 'TXXX=MusicBrainz Album Release Country',
+    'musicbrainz_discid': 'TXXX=MusicBrainz Disc Id',
+    'asin': 'TXXX=ASIN',
+    'performer': 'TXXX=PERFORMER',
+    'barcode': 'TXXX=BARCODE',
+    'catalognumber': 'TXXX=CATALOGNUMBER',
+    'musicbrainz_releasetrackid': 'TXXX=MusicBrainz Release Track Id',
+    'musicbrainz_releasegroupid': 'TXXX=MusicBrainz Release Group Id',
+    'musicbrainz_workid': 'TXXX=MusicBrainz Work Id',
+    'acoustid_fingerprint': 'TXXX=Acoustid Fingerprint',
+    'acoustid_id': 'TXXX=Acoustid Id',
+}
+
+# image types lame can embed, and the flac picture type for a front cover
+ART_EXTENSIONS = {'image/jpeg': '.jpg', 'image/png': '.png', 'image/gif': '.gif'}
+FRONT_COVER = 3
+
+# pictures read from flacs at once by each worker, as scans can be tens of megabytes
+ART_READERS = 1
+# bytes of processed cover art kept by each worker, keyed by the hash of the original
+# image. Covers larger than this on their own aren't kept.
+ART_CACHE_BYTES = 8 << 20
+ART_JPEG_QUALITY = 90
+
+# encoders usable in output profiles: (extension, command line before the profile's
+# arguments). Encoders read a wav from stdin and are given "- DEST" as their last args
+ENCODERS = {
+    'lame': ('.mp3', ('lame', '--silent')),
+    'opusenc': ('.opus', ('opusenc', '--quiet')),
+}
+
+# folders modified this recently aren't cached by --index, as more changes within
+# the resolution of their mtime would go unnoticed
+INDEX_RACY_SECONDS = 2
+
+# inotify event flags used by InotifyWatcher, see inotify(7)
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+# mp3s are encoded to "DEST.convertFlac-part" and only renamed once complete
+TEMP_SUFFIX = '.convertFlac-part'
+
+# number of frames decoded at a time when decoding in-process, and the size of the
+# blocks read from flac when its output is shared between several encoders
+PCM_BLOCK_FRAMES = 1 << 16
+PCM_BLOCK_BYTES = 1 << 18
+
+# frames of audio encoded either side of each chunk of a split flac and then dropped,
+# so that the frames kept are encoded as they would be in a single pass
+CHUNK_OVERLAP_FRAMES = 8
+
+# cue sheet commands and the tags they set on a track, or on the album outside a track
+CUE_TRACK_TAGS = {'TITLE': 'title', 'PERFORMER': 'artist', 'SONGWRITER': 'composer'}
+CUE_ALBUM_TAGS = {'TITLE': 'album', 'PERFORMER': 'artist', 'SONGWRITER': 'composer',
+                  'DATE': 'date', 'GENRE': 'genre'}
+
+# mpeg audio layer III bitrates in kbps by bitrate index, for MPEG-1 and MPEG-2/2.5
+MP3_BITRATES = ((0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+                (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160))
+MP3_SAMPLE_RATES = (44100, 48000, 32000)
+
+# threads reading flac headers during --preflight
+PREFLIGHT_WORKERS = 16
+
+# cloned files waiting to be copied, per --io-workers thread
+COPY_QUEUE_FACTOR = 4
+
+# source folders whose output folder each PathMapper remembers
+PATH_CACHE_FOLDERS = 4096
+
+# format of the json written by plan_conversion()
+PLAN_VERSION = 1
+# seconds of audio encoded to measure encoding speed for a plan
+CALIBRATION_SECONDS = 20
+
+# rough flac bitrate, used to guess track length when STREAMINFO can't be read
+FLAC_BYTES_PER_SECOND = 110000
+
+# with --num-cores=AUTO, new jobs are admitted while cpu utilization is below this
+MAX_CPU_UTILIZATION = 0.9
+ADMISSION_INTERVAL = 0.25
 
 
 def convert(targets,
@@ -94,6 +443,30 @@ def convert(targets,
             num_cores=None,
             nice_val=10,
             replacement=None,
+            manifest=None,
+            decoder='flac',
+            order='discovery',
+            stats=None,
+            metrics=None,
+            tagger='lame',
+            resume=False,
+            dedup=False,
+            link='copy',
+            io_workers=4,
+            profiles=None,
+            index=None,
+            pool=None,
+            changed=None,
+            split=None,
+            cue=False,
+            read_ahead=None,
+            max_readers=1,
+            max_writers=None,
+            preflight=False,
+            art_size=None,
+            art_max_kb=None,
+            plan=None,
+            on_result=None,
             verbose=False):
     """
     Convert given target files/folders into mp3 using flac and lame
@@ -110,38 +483,198 @@ def convert(targets,
     lame args).
     :param overwrite: Overwrite existing files.
     :param delete_flacs: delete original flac files after conversion.
-    :return: None
+    :param manifest: path to a sqlite manifest of completed conversions. Unchanged
+    sources already recorded in it are skipped.
+    :param decoder: "flac" to decode with the flac binary, or "soundfile" to decode
+    in-process with libsndfile.
+    :param num_cores: number of concurrent conversions, or 'auto' to admit new
+    conversions based on measured cpu utilization.
+    :param order: "discovery" to convert files as they are found, or "largest" to
+    convert the longest tracks first.
+    :param stats: optional dict that will be filled with the number of files converted
+    and the seconds spent discovering, cloning, encoding and tagging. Encoding and
+    tagging are totals across all workers.
+    :param metrics: file, "tcp://HOST:PORT" or "unix:PATH" to stream json line events
+    for each conversion to. A summary of timing percentiles is printed at the end.
+    :param tagger: "lame" to have lame write the tags and cover art while encoding, or
+    "mutagen" to add the tags to the finished mp3 with copy_tags().
+    :param resume: remove partial outputs left by an interrupted run from the output
+    folder and cloned folders, and reuse folders it already cloned.
+    :param dedup: encode flacs with identical audio once. The first mp3 is copied to
+    the destinations of the others after all other conversions are done, and retagged
+    (or hardlinked if the tags are identical too).
+    :param link: "copy", "reflink" or "hardlink", how cloned files are copied. See
+    copy_file().
+    :param io_workers: number of threads copying cloned files. Cloning happens
+    alongside the conversions rather than before them.
+    :param profiles: list of Profiles or "NAME=ENCODER [ARGS]" strings to encode each
+    flac to, from a single decode. See generate_outputs() for where each profile's
+    outputs go. A single lame profile is the same as passing its lame_args.
+    :param index: path to a sqlite cache of directory listings, see DirectoryIndex.
+    :param pool: executor to run the conversions on instead of starting a process pool.
+    It is left running afterwards.
+    :param changed: absolute paths of files to convert, or copy when cloning, instead
+    of searching the target folders. Used by watch().
+    :param split: encode flacs longer than this many seconds in chunks of about that
+    length in parallel, see _split_convert(). Only applies to mp3s.
+    :param cue: split flac images with a cue sheet into an mp3 per track, see
+    find_cue(). Only applies to mp3s.
+    :param read_ahead: megabytes of flacs to read into memory ahead of converting them,
+    with max_readers threads, counting the copy sent to the converting process too.
+    See ReadAhead.
+    :param max_writers: number of threads moving mp3s into the output. mp3s are encoded
+    to a local temporary folder first, so that at most this many are written to the
+    output at once.
+    :param preflight: check the headers of all flacs with check_flac() before starting
+    any conversions, skipping bad ones. Conversions then report an estimate of the
+    time left.
+    :param art_size: scale cover art down to at most this many pixels on its longest
+    side, see read_cover()
+    :param art_max_kb: leave out cover art larger than this many kilobytes
+    :param plan: a plan from plan_conversion(), or the path of one saved as json. Its
+    files are converted instead of searching targets, with the lame settings or
+    profiles it was made with.
+    :param on_result: called with the JobResult of each job as it finishes, from a
+    callback thread. Results are not kept otherwise, so memory use doesn't grow with
+    the number of flacs.
     """
 
     output = output.decode('utf8') if isinstance(output, bytes) else output
 
     if iter(targets) is iter(targets):
         targets = (t.decode('utf8') if isinstance(t, bytes) else t for t in targets)
+        # targets are only read once, so the folders among them are noted for resume
+        source_folders = []
+        targets = _noting_folders(targets, source_folders)
     else:
         targets = {t.decode('utf8') if isinstance(t, bytes) else t for t in targets}
+        source_folders = [t for t in targets if os.path.isdir(t)]
 
     if replacement:
-        if not replacement.startswith('s'):
-            raise ValueError('replacement string must start with "s[SEPERATOR_CHAR]"')
-        sep = replacement[1]
-        if replacement.count(sep) != 3:
-            raise ValueError("replacement string must be in sed format. eg:'s/pat/repl/"
-                             " (no flags)'")
-        replacement = tuple(replacement.split(sep)[1:3])
+        replacement = parse_replacement(replacement)
 
-    folders_to_clone, target_files = generate_outputs(targets,
-                                                      output,
-                                                      clone=clone,
-                                                      recursive=recursive,
-                                                      folder_suffix=folder_suffix,
-                                                      sub=replacement)
+    if plan is not None:
+        plan = plan if isinstance(plan, dict) else load_plan(plan)
+        vbr_level, cbr, lame_args, profiles = (plan['settings'][key] for key in (
+            'vbr_level', 'cbr', 'lame_args', 'profiles'))
+
+    if decoder not in ('flac', 'soundfile'):
+        raise ValueError('decoder must be either "flac" or "soundfile"')
+    if decoder == 'soundfile' and soundfile is None:
+        warnings.warn('soundfile is not installed, decoding with flac instead.')
+    if order not in ('discovery', 'largest'):
+        raise ValueError('order must be either "discovery" or "largest"')
+    if tagger not in ('lame', 'mutagen'):
+        raise ValueError('tagger must be either "lame" or "mutagen"')
+    if link not in ('copy', 'reflink', 'hardlink'):
+        raise ValueError('link must be one of "copy", "reflink" or "hardlink"')
+
+    if profiles:
+        profiles = [p if isinstance(p, Profile) else parse_profile(p) for p in profiles]
+        if len(profiles) == 1 and profiles[0].encoder == 'lame':
+            lame_args = ' '.join(profiles[0].args)
+    multi = bool(profiles) and (len(profiles) > 1 or profiles[0].encoder != 'lame')
+    if multi and dedup:
+        raise ValueError('dedup is not supported with multiple or non-lame profiles')
+
+    if index is not None and not isinstance(index, DirectoryIndex):
+        index = DirectoryIndex(index)
+
+    stats = {} if stats is None else stats
+    for stage in ('discovery', 'cloning', 'encoding', 'tagging', 'preflight'):
+        stats[stage] = 0.0
+    stats['files'] = stats['failed'] = 0
+
+    def timed_copy(source, dest):
+        start = time.time()
+        try:
+            copy_file(source, dest, link=link)
+        except (IOError, OSError) as e:
+            copy_errors.append((source, dest, e))
+        finally:
+            stats['cloning'] += time.time() - start
+            copy_slots.release()
+
+    def queue_copy(source, dest):
+        if resume and os.path.exists(dest):
+            return
+        copy_slots.acquire()
+        io_pool.submit(timed_copy, source, dest)
 
+    # cloned files are copied while the flacs are found and converted, with a bounded
+    # queue so that a large tree isn't held in memory
+    io_workers = max(int(io_workers), 1)
+    io_pool = ThreadPoolExecutor(max_workers=io_workers)
+    copy_slots = threading.BoundedSemaphore(io_workers * COPY_QUEUE_FACTOR)
+    copy_errors = []
+    # folders are only cloned on the fly when they are searched for flacs
+    on_clone = queue_copy if clone and plan is None and changed is None else None
+
+    start = time.time()
+    if plan is not None:
+        folders_to_clone = [tuple(pair) for pair in plan['clone']['roots']]
+        target_files = [(f['source'], _as_dest(f['dest'])) for f in plan['files']]
+    else:
+        folders_to_clone, target_files = generate_outputs(targets,
+                                                          output,
+                                                          clone=clone,
+                                                          recursive=recursive,
+                                                          folder_suffix=folder_suffix,
+                                                          sub=replacement,
+                                                          profiles=profiles,
+                                                          index=index,
+                                                          changed=changed,
+                                                          on_clone=on_clone)
+    stats['discovery'] += time.time() - start
+    target_files = _timed(target_files, stats, 'discovery')
+
+    if multi and plan is None:
+        # cloned folders and outputs come in tuples, one per profile
+        folders_to_clone = [(source, dest) for source, dests in folders_to_clone
+                            for dest in (dests if len(profiles) > 1 else (dests, ))]
+
+    if resume:
+        roots = _resume_roots(output, folders_to_clone, source_folders)
+        removed = sum(clean_partials(root) for root in roots if os.path.isdir(root))
+        print('Removed {} partial files.'.format(removed))
+
+    # the folder structure of a plan or of changed files is created up front, the
+    # files are copied alongside encoding
     print('Cloning folders...')
+    start = time.time()
+    to_copy = []
+    if plan is not None:
+        for folder in plan['clone']['folders']:
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+        to_copy = [tuple(pair) for pair in plan['clone']['files']
+                   if not resume or not os.path.exists(pair[1])]
+        folders_to_clone = []
     for source, dest in folders_to_clone:
-        clone_folder(source, dest, recursive=recursive)
+        if changed is None:
+            if recursive and os.path.exists(dest) and not resume:
+                raise IOError('destination folder "{}" already exists, cannot copy '
+                              'recursivly'.format(dest))
+            continue
+        for f in changed:
+            if not f.endswith('.flac') and _in_folder(f, source, recursive):
+                new_file = os.path.join(dest, os.path.relpath(f, source))
+                _make_parent(new_file)
+                to_copy.append((f, new_file))
+    stats['cloning'] += time.time() - start
+    for source, dest in to_copy:
+        queue_copy(source, dest)
 
     # lame_args need to be in tuple format for subprocess call
     lame_args = tuple(lame_args.split()) if lame_args else None
+    settings = ' '.join(lame_settings(vbr_level, cbr, lame_args))
+    if multi:
+        settings = [profile.settings for profile in profiles]
+    if manifest is not None and not isinstance(manifest, Manifest):
+        manifest = Manifest(manifest)
+    if metrics is not None and not isinstance(metrics, MetricsStream):
+        metrics = MetricsStream(metrics)
+    samples = collections.defaultdict(lambda: array.array('d'))
     print_queue = queue.Queue()
 
     def print_manager():
@@ -155,33 +688,58 @@ def convert(targets,
     t.start()
     del t
 
-    def conversion_callback(future):
-        old, new = future.result()
-        if not new:
-            warnings.warn('error converting {}'.format(old))
+    def conversion_callback(result):
+        if on_result is not None:
+            on_result(result)
+        progress[0] += durations.get(result.source, 0.0)
+        for message in result.messages:
+            print_queue.put(message)
+        stats['encoding'] += result.timings.get('encode', 0.0)
+        stats['tagging'] += result.timings.get('tag', 0.0)
+        for key, value in result.timings.items():
+            samples[key].append(value)
+        if metrics is not None:
+            metrics.emit('job', **result.as_dict())
+        if result.status == 'skipped':
             return
-        if verbose:
-            try:
-                print_queue.put('Conversion done for {}\nCopying tags...'.format(old))
-            except UnicodeEncodeError:
-                print_queue.put('Conversion Done for {}\nCopying tags...'.format(
-                    old.encode('mbcs', 'replace')))
+        if not result.ok:
+            stats['failed'] += 1
+            failed.add(result.dest)
+            warnings.warn('error converting {}'.format(result.source))
+            return
+        stats['files'] += 1
 
-        copy_tags(old, new, verbose=True, print_queue=print_queue)
-        if verbose:
+        if manifest is not None:
+            if multi:
+                for dest, profile_settings in zip(_as_tuple(result.dest), settings):
+                    manifest.record(result.source, dest, profile_settings,
+                                    result.fingerprint)
+            else:
+                # a split image has one dest per track
+                for dest in _as_tuple(result.dest):
+                    manifest.record(result.source, dest, settings, result.fingerprint)
+        if verbose and durations:
+            elapsed = time.time() - progress[1]
+            remaining = elapsed * (total_duration - progress[0]) / max(progress[0], 1e-6)
+            print_queue.put('Done! About {} left.\n'.format(format_duration(remaining)))
+        elif verbose:
             print_queue.put('Done!\n')
 
         if delete_flacs:
-            os.remove(old)
+            os.remove(result.source)
             try:
-                os.rmdir(os.path.dirname(source))
+                os.rmdir(os.path.dirname(result.source))
             except OSError:
                 pass
 
+    monitor = None
+    if isinstance(num_cores, str) and num_cores.lower() == 'auto':
+        monitor = CpuMonitor()
+        num_cores = cpu_count()
     num_cores = 0 if not num_cores else int(num_cores)
 
     if not num_cores:
-        num_cores = cpu_count() // 2
+        num_cores = max(cpu_count() // 2, 1)
 
     kwargs = {
         'vbr': vbr_level,
@@ -189,18 +747,707 @@ def convert(targets,
         'lame_args': lame_args,
         'overwrite': overwrite,
         'nice_val': nice_val,
+        'decoder': decoder,
+        'tagger': tagger,
+        'fingerprint': manifest is not None,
+        'verbose': verbose,
+        'art_size': int(art_size) if art_size else None,
+        'art_max_bytes': int(float(art_max_kb) * 1024) if art_max_kb else None,
     }
 
-    with ThreadPoolExecutor(max_workers=num_cores) as pool:
-        print('Beginning conversion for {} files.'.format(len(target_files)))
+    if multi:
+        kwargs['profiles'] = profiles
+    elif split:
+        kwargs['split'] = float(split)
+    if (cue or split) and not multi:
+        # a split image's tracks, or a long flac's chunks, share the cpus left over by
+        # the other jobs
+        kwargs['threads'] = max(cpu_count() // num_cores, 1)
+
+    if manifest is not None:
+        # anything not recorded as current is stale, including partial outputs left
+        # behind by an interrupted run
+        kwargs['overwrite'] = True
+
+    durations = {}
+    if plan is not None:
+        durations = {f['source']: f['seconds'] for f in plan['files']}
+    if preflight:
+        start = time.time()
+        target_files, durations, rejected = check_flacs(target_files)
+        stats['preflight'] = time.time() - start
+        print('Checked {} flacs in {:.1f}s: {} ok, {} rejected, {} of audio.'.format(
+            len(target_files) + len(rejected), stats['preflight'], len(target_files),
+            len(rejected), format_duration(sum(durations.values()))))
+        for source, reason in rejected:
+            print('  rejected "{}": {}'.format(source, reason))
+        stats['failed'] += len(rejected)
+    # audio converted so far and when conversions started, for estimating time left
+    total_duration = sum(durations.values())
+    progress = [0.0, time.time()]
+
+    if order == 'largest':
+        length = durations.get if durations else estimate_duration
+        target_files = sorted(target_files, key=lambda t: length(t[0]), reverse=True)
+
+    # bound the number of queued jobs so that encoding starts as soon as the first
+    # flac is found and memory stays flat no matter how large the library is. When
+    # admitting by cpu load nothing is queued, each job starts as it is admitted.
+    slots = threading.BoundedSemaphore(num_cores if monitor else num_cores * 2)
+    in_flight = [0]
+    in_flight_lock = threading.Lock()
+    idle = threading.Condition(in_flight_lock)
+    submitted = [0]
+    failed = set()
+
+    # flacs are read ahead on reader threads and mp3s written out on writer threads,
+    # so that disk and cpu parallelism can be set separately
+    if read_ahead:
+        # the job's process gets its own copy of what was read, counted in the budget
+        read_ahead = ReadAhead(float(read_ahead) * 1e6, readers=max_readers, copies=2)
+    scratch, writers = None, None
+    if max_writers:
+        scratch = tempfile.mkdtemp(prefix='convertFlac-')
+        writers = ThreadPoolExecutor(max_workers=max(int(max_writers), 1))
+
+    def job_done(future, source, dest, reserved=0):
+        if reserved:
+            read_ahead.release(reserved)
+        try:
+            result = future.result()
+        except Exception as e:
+            result = JobResult(source, dest, messages=[str(e)])
+        if result.staged is not None:
+            writers.submit(write_staged, result)
+            return
+        finish_job(result)
+
+    def write_staged(result):
+        start = time.time()
+        try:
+            _make_parent(result.dest)
+            partial = result.dest + TEMP_SUFFIX
+            shutil.move(result.staged, partial)
+            os.replace(partial, result.dest)
+        except (IOError, OSError) as e:
+            result.ok = False
+            result.messages.append('could not write "{}": {}'.format(result.dest, e))
+            for path in (result.staged, result.dest + TEMP_SUFFIX):
+                if os.path.exists(path):
+                    os.remove(path)
+        result.timings['write'] = time.time() - start
+        finish_job(result)
+
+    def finish_job(result):
+        try:
+            conversion_callback(result)
+        finally:
+            with in_flight_lock:
+                in_flight[0] -= 1
+                idle.notify_all()
+            slots.release()
+
+    def submit(job, *args):
+        slots.acquire()
+        while monitor is not None and in_flight[0]:
+            # give the last job time to ramp up before measuring again
+            time.sleep(ADMISSION_INTERVAL)
+            if monitor.utilization() < MAX_CPU_UTILIZATION or not in_flight[0]:
+                break
+        with in_flight_lock:
+            in_flight[0] += 1
+        submitted[0] += 1
+        if read_ahead and job is _convert_job:
+            read, reserved = read_ahead.read(args[0])
+            read.add_done_callback(lambda read: start(job, args, read, reserved))
+        else:
+            start(job, args)
+
+    def start(job, args, read=None, reserved=0):
+        job_kwargs = dict(kwargs)
+        if job is _convert_job:
+            if read is not None and read.exception() is None:
+                job_kwargs['data'] = read.result()
+            job_kwargs['scratch'] = scratch
+        # a duplicate's own source and dest follow those of the flac it copies
+        source, dest = args[2:4] if job is _duplicate_job else args[:2]
+        future = pool.submit(job, *args, submitted=time.time(), **job_kwargs)
+        future.add_done_callback(
+            functools.partial(job_done, source=source, dest=dest, reserved=reserved))
+
+    # audio already being encoded -> (source, dest) of the flac encoding it
+    leaders = {}
+    duplicates = []
+    own_pool = pool is None
+    if own_pool:
+        pool = ProcessPoolExecutor(max_workers=num_cores)
+    try:
+        print('Beginning conversion...')
         for source, dest in target_files:
-            if not target_is_valid(source):
-                warnings.warn(
-                    ('The target "{}" could not be found or is not a ".flac" file. '
-                     'Skipping...').format(source))
-            pool.submit(_do_convert, source, dest,
-                        **kwargs).add_done_callback(conversion_callback)
+            if multi:
+                if manifest is not None and all(
+                        manifest.is_current(source, d, profile_settings)
+                        for d, profile_settings in zip(_as_tuple(dest), settings)):
+                    if verbose:
+                        print_queue.put('"{}" is up to date, skipping...'.format(source))
+                    continue
+                submit(_profiles_job, source, _as_tuple(dest))
+                continue
+            tracks = find_cue(source) if cue else None
+            if tracks is not None:
+                dests = tuple(cue_track_path(dest, track) for track in tracks)
+                if manifest is not None and all(
+                        manifest.is_current(source, d, settings) for d in dests):
+                    if verbose:
+                        print_queue.put('"{}" is up to date, skipping...'.format(source))
+                    continue
+                submit(_cue_job, source, dests, tracks)
+                continue
+            if manifest is not None and manifest.is_current(source, dest, settings):
+                if verbose:
+                    print_queue.put('"{}" is up to date, skipping...'.format(dest))
+                continue
+            if dedup:
+                key = dedup_key(source)
+                if key in leaders:
+                    duplicates.append((source, dest, key))
+                    continue
+                if key is not None:
+                    leaders[key] = (source, dest)
+            submit(_convert_job, source, dest)
+
+        if duplicates:
+            with in_flight_lock:
+                idle.wait_for(lambda: not in_flight[0])
+            print('Copying {} duplicate files...'.format(len(duplicates)))
+        for source, dest, key in duplicates:
+            leader_source, leader_dest = leaders[key]
+            if leader_dest in failed or not os.path.exists(leader_dest):
+                submit(_convert_job, source, dest)
+            else:
+                submit(_duplicate_job, leader_source, leader_dest, source, dest)
+        with in_flight_lock:
+            idle.wait_for(lambda: not in_flight[0])
+    finally:
+        if own_pool:
+            pool.shutdown()
+        if read_ahead:
+            read_ahead.close()
+        if writers is not None:
+            writers.shutdown()
+            shutil.rmtree(scratch, ignore_errors=True)
+    io_pool.shutdown()
+    for source, dest, error in copy_errors:
+        warnings.warn('error copying "{}" to "{}": {}'.format(source, dest, error))
     print_queue.join()
+    print('Finished conversion for {} files.'.format(submitted[0]))
+    if index is not None:
+        index.close()
+    stats['summary'] = summarize_timings(samples)
+    if metrics is not None:
+        metrics.emit('summary', files=stats['files'], failed=stats['failed'],
+                     timings=stats['summary'])
+        metrics.close()
+        print_summary(stats['summary'])
+    if manifest is not None:
+        manifest.close()
+
+
+async def convert_async(targets,
+                        output=None,
+                        recursive=False,
+                        clone=False,
+                        folder_suffix=None,
+                        vbr_level=0,
+                        cbr=None,
+                        lame_args=None,
+                        overwrite=False,
+                        num_cores=None,
+                        nice_val=10,
+                        replacement=None,
+                        tagger='lame',
+                        link='copy'):
+    """
+    asyncio version of convert(), an async generator yielding a JobResult for each
+    flac as its conversion finishes.
+
+    flac and lame run as asyncio subprocesses joined by a pipe, so no thread or process
+    is tied up per conversion. Searching folders, cloning and reading tags run in the
+    event loop's default executor. Closing the generator, or cancelling the task
+    iterating over it, kills the conversions still running and removes their partial
+    mp3s.
+    :param num_cores: number of conversions to run at once, see convert()
+    See convert() for the other parameters.
+    """
+    loop = asyncio.get_event_loop()
+    if tagger not in ('lame', 'mutagen'):
+        raise ValueError('tagger must be either "lame" or "mutagen"')
+    if replacement:
+        replacement = parse_replacement(replacement)
+    lame_args = tuple(lame_args.split()) if lame_args else None
+
+    folders_to_clone, target_files = generate_outputs(list(targets),
+                                                      output,
+                                                      clone=clone,
+                                                      recursive=recursive,
+                                                      folder_suffix=folder_suffix,
+                                                      sub=replacement)
+    for source, dest in folders_to_clone:
+        to_copy = await loop.run_in_executor(None, prepare_clone, source, dest,
+                                             recursive)
+        await asyncio.gather(*(loop.run_in_executor(None, copy_file, f, new_file, link)
+                               for f, new_file in to_copy))
+
+    target_files = iter(target_files)
+    limit = _pool_size(num_cores)
+    pending = set()
+    found_all = False
+    try:
+        while True:
+            while not found_all and len(pending) < limit:
+                target = await loop.run_in_executor(None, next, target_files, None)
+                if target is None:
+                    found_all = True
+                    break
+                pending.add(asyncio.ensure_future(
+                    _convert_async(target[0], target[1], vbr=vbr_level, cbr=cbr,
+                                   lame_args=lame_args, overwrite=overwrite,
+                                   nice_val=nice_val, tagger=tagger)))
+            if not pending:
+                return
+            done, pending = await asyncio.wait(pending,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+
+
+def plan_conversion(targets,
+                    output=None,
+                    clone=False,
+                    recursive=False,
+                    folder_suffix=None,
+                    vbr_level=0,
+                    cbr=None,
+                    lame_args=None,
+                    num_cores=None,
+                    replacement=None,
+                    profiles=None,
+                    calibrate=True):
+    """
+    Works out what convert() would do with the same arguments, without converting or
+    writing anything: the folders and files it would create, destinations that more
+    than one source maps to, and how much output and time it would take. Durations
+    come from each flac's STREAMINFO, and the encoding speed and bitrate from encoding
+    the start of the longest flac with calibrate_encoder().
+    :param calibrate: set to False to skip the test encode and leave out the estimates
+    :return: plan dict, which can be saved as json and given to convert() to carry it
+    out without searching the targets again
+    """
+    output = output.decode('utf8') if isinstance(output, bytes) else output
+    targets = [t.decode('utf8') if isinstance(t, bytes) else t for t in targets]
+    sub = parse_replacement(replacement) if replacement else None
+    if profiles:
+        profiles = [p if isinstance(p, Profile) else parse_profile(p) for p in profiles]
+    multi = bool(profiles) and (len(profiles) > 1 or profiles[0].encoder != 'lame')
+
+    folders_to_clone, target_files = generate_outputs(targets,
+                                                      output,
+                                                      clone=clone,
+                                                      recursive=recursive,
+                                                      folder_suffix=folder_suffix,
+                                                      sub=sub,
+                                                      profiles=profiles)
+    target_files, durations, rejected = check_flacs(target_files)
+    if multi:
+        folders_to_clone = [(source, dest) for source, dests in folders_to_clone
+                            for dest in (dests if len(profiles) > 1 else (dests, ))]
+    folders, to_copy = [], []
+    for source, dest in folders_to_clone:
+        new_folders, files = list_clone(source, dest, recursive=recursive)
+        folders += new_folders
+        to_copy += files
+
+    sources = collections.defaultdict(list)
+    for source, dest in target_files:
+        for d in _as_tuple(dest):
+            sources[d].append(source)
+    collisions = [{'dest': dest, 'sources': s}
+                  for dest, s in sources.items() if len(s) > 1]
+
+    files = [{
+        'source': source,
+        'dest': dest,
+        'seconds': durations[source],
+        'bytes': os.path.getsize(source),
+        'exists': any(os.path.exists(d) for d in _as_tuple(dest)),
+    } for source, dest in target_files]
+    audio_seconds = sum(durations.values())
+    estimate = {
+        'audio_seconds': audio_seconds,
+        'input_bytes': sum(f['bytes'] for f in files),
+        'output_bytes': None,
+        'encode_seconds': None,
+        'realtime_factor': None,
+        'cores': _pool_size(num_cores),
+    }
+    if calibrate and files:
+        if multi:
+            commands = [profile.command((), '-') for profile in profiles]
+        else:
+            args = tuple(lame_args.split()) if lame_args else None
+            commands = [('lame', '--silent') + lame_settings(vbr_level, cbr, args)
+                        + ('-', '-')]
+        longest = max(files, key=lambda f: f['seconds'])['source']
+        measured = calibrate_encoder(longest, commands)
+        if measured is not None:
+            realtime_factor, bytes_per_second = measured
+            estimate.update(
+                output_bytes=int(bytes_per_second * audio_seconds),
+                encode_seconds=audio_seconds / (realtime_factor * estimate['cores']),
+                realtime_factor=realtime_factor)
+
+    return {
+        'version': PLAN_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': socket.gethostname(),
+        'settings': {
+            'vbr_level': vbr_level,
+            'cbr': cbr,
+            'lame_args': lame_args,
+            'profiles': ['{}={}'.format(p.name, p.settings)
+                         for p in profiles] if profiles else None,
+        },
+        'clone': {
+            'roots': folders_to_clone,
+            'folders': folders,
+            'files': to_copy,
+        },
+        'files': files,
+        'rejected': [{'source': source, 'reason': reason} for source, reason in rejected],
+        'collisions': collisions,
+        'estimate': estimate,
+    }
+
+
+def load_plan(path):
+    """reads a plan saved by plan_conversion()"""
+    with open(path) as f:
+        plan = json.load(f)
+    if plan.get('version') != PLAN_VERSION:
+        raise ValueError('"{}" is not a version {} plan'.format(path, PLAN_VERSION))
+    return plan
+
+
+def print_plan(plan):
+    """prints a summary of a plan from plan_conversion()"""
+    estimate = plan['estimate']
+    existing = sum(1 for f in plan['files'] if f['exists'])
+    print('{} flacs, {} of audio, {:.1f} MB. {} already converted.'.format(
+        len(plan['files']), format_duration(estimate['audio_seconds']),
+        estimate['input_bytes'] / 1e6, existing))
+    print('{} folders to create, {} other files to copy.'.format(
+        len(plan['clone']['folders']), len(plan['clone']['files'])))
+    if estimate['encode_seconds'] is not None:
+        print('Estimated output {:.1f} MB, encoding for about {} on {} cores '
+              '({:.1f}x realtime per core).'.format(
+                  estimate['output_bytes'] / 1e6,
+                  format_duration(estimate['encode_seconds']), estimate['cores'],
+                  estimate['realtime_factor']))
+    for rejected in plan['rejected']:
+        print('  rejected "{}": {}'.format(rejected['source'], rejected['reason']))
+    for collision in plan['collisions']:
+        print('  collision at "{}" from: {}'.format(
+            collision['dest'], ', '.join('"{}"'.format(s) for s in collision['sources'])))
+
+
+def watch(targets,
+          settle=5.0,
+          interval=2.0,
+          polling=False,
+          num_cores=None,
+          clone=False,
+          recursive=False,
+          resume=False,
+          **kwargs):
+    """
+    Converts the target folders like convert(), then keeps running and converts flac
+    files as they are added to them. A new file is converted once its size and mtime
+    have stayed the same for settle seconds. Conversions share one process pool for
+    as long as this runs, which is until it is interrupted.
+    :param targets: list of folders to watch
+    :param settle: seconds a new file has to stay unchanged before it is converted
+    :param interval: seconds between checks for new files
+    :param polling: poll the folders for new files rather than using inotify
+    :param resume: see convert(). The first conversion always resumes when cloning, so
+    that folders cloned by an earlier watch are reused.
+    Other parameters are passed on to convert().
+    :return: None
+    """
+    folders = []
+    for target in targets:
+        target = target.decode('utf8') if isinstance(target, bytes) else target
+        if not os.path.isdir(target):
+            raise ValueError('"{}" is not a folder, only folders can be watched'.format(
+                target))
+        folders.append(os.path.abspath(target))
+
+    # start watching before the first conversion so nothing added during it is missed
+    watcher = None
+    if not polling:
+        try:
+            watcher = InotifyWatcher(folders, recursive)
+        except (AttributeError, OSError) as e:
+            warnings.warn('inotify is not available ({}), polling instead.'.format(e))
+    if watcher is None:
+        watcher = PollingWatcher(folders, recursive)
+
+    workers = _pool_size(num_cores)
+    kwargs.update(num_cores=num_cores, clone=clone, recursive=recursive)
+
+    # path -> ((size, mtime), time it was first seen at that size), or None until the
+    # next check
+    pending = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_ignore_interrupt) as pool:
+        try:
+            convert(folders, pool=pool, resume=resume or clone, **kwargs)
+            print('Watching {} folders for new files...'.format(len(folders)))
+            while True:
+                timeout = min(interval, settle) if pending else interval
+                for path in watcher.changes(timeout):
+                    if path.endswith(TEMP_SUFFIX):
+                        continue
+                    if clone or path.endswith('.flac'):
+                        pending[path] = None
+                now = time.time()
+                ready = []
+                for path, last in list(pending.items()):
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        del pending[path]
+                        continue
+                    current = (st.st_size, st.st_mtime)
+                    if last is None or last[0] != current:
+                        pending[path] = (current, now)
+                    elif now - last[1] >= settle:
+                        ready.append(path)
+                        del pending[path]
+                if ready:
+                    convert(folders, pool=pool, changed=ready, **kwargs)
+        except KeyboardInterrupt:
+            print('Stopping...')
+        finally:
+            watcher.close()
+
+
+def coordinate(targets,
+               broker,
+               output=None,
+               clone=False,
+               recursive=False,
+               folder_suffix=None,
+               vbr_level=0,
+               cbr=None,
+               lame_args=None,
+               overwrite=False,
+               nice_val=10,
+               replacement=None,
+               decoder='flac',
+               tagger='lame',
+               resume=False,
+               link='copy',
+               retries=2,
+               interval=5.0,
+               art_size=None,
+               art_max_kb=None,
+               verbose=False):
+    """
+    Publishes a conversion to a JobBroker for workers on other hosts to run with
+    work(), then waits for them to finish it. Folders are cloned here while the
+    workers convert. Jobs are published as they are found, so workers can start
+    straight away.
+    :param broker: JobBroker or path to its database. Any jobs already in it are
+    removed first.
+    :param retries: how many times a failed job is retried
+    :param interval: seconds between progress reports
+    See convert() for the other parameters.
+    :return: dict of worker -> throughput, see JobBroker.throughput()
+    """
+    broker = broker if isinstance(broker, JobBroker) else JobBroker(broker)
+    if replacement:
+        replacement = parse_replacement(replacement)
+    lame_args = tuple(lame_args.split()) if lame_args else None
+    settings = {
+        'vbr': vbr_level,
+        'cbr': cbr,
+        'lame_args': lame_args,
+        'overwrite': overwrite,
+        'nice_val': nice_val,
+        'decoder': decoder,
+        'tagger': tagger,
+        'art_size': int(art_size) if art_size else None,
+        'art_max_bytes': int(float(art_max_kb) * 1024) if art_max_kb else None,
+    }
+
+    targets = list(targets)
+    folders_to_clone, target_files = generate_outputs(targets,
+                                                      output,
+                                                      clone=clone,
+                                                      recursive=recursive,
+                                                      folder_suffix=folder_suffix,
+                                                      sub=replacement)
+    if resume:
+        roots = _resume_roots(output, folders_to_clone,
+                              [t for t in targets if os.path.isdir(t)])
+        removed = sum(clean_partials(root) for root in roots if os.path.isdir(root))
+        print('Removed {} partial files.'.format(removed))
+    to_copy = []
+    for source, dest in folders_to_clone:
+        to_copy += prepare_clone(source, dest, recursive=recursive, resume=resume)
+
+    broker.reset(retries=retries)
+    published = 0
+    batch = []
+    for source, dest in target_files:
+        if not overwrite and os.path.exists(dest):
+            if verbose:
+                print('"{}" already exists! skipping...'.format(dest))
+            continue
+        batch.append((source, dest))
+        if len(batch) >= 1000:
+            published += broker.publish(batch, settings)
+            batch = []
+    published += broker.publish(batch, settings)
+    broker.close_publishing()
+    print('Published {} jobs to "{}".'.format(published, broker.path))
+
+    print('Cloning folders...')
+    for source, dest in to_copy:
+        try:
+            copy_file(source, dest, link=link)
+        except (IOError, OSError) as e:
+            warnings.warn('error copying "{}" to "{}": {}'.format(source, dest, e))
+
+    while not broker.finished():
+        time.sleep(interval)
+        counts = broker.counts()
+        print('{done}/{total} done, {leased} converting, {failed} failed'.format(
+            total=published, **counts))
+
+    for source, error in broker.failures():
+        warnings.warn('error converting {}: {}'.format(source, error))
+    throughput = broker.throughput()
+    print('{:<30} {:>8} {:>10} {:>10}'.format('worker', 'files', 'files/min', 'MB/s'))
+    for worker, totals in sorted(throughput.items()):
+        seconds = max(totals['seconds'], 1e-6)
+        print('{:<30} {:>8} {:>10.1f} {:>10.2f}'.format(
+            worker, totals['files'], totals['files'] * 60 / seconds,
+            totals['bytes_in'] / seconds / 1e6))
+    broker.close()
+    return throughput
+
+
+def work(broker, name=None, num_cores=None, lease=300.0, interval=5.0, verbose=False):
+    """
+    Runs jobs leased from a JobBroker until the coordinator has published all of them
+    and none are left. Leases are renewed while their jobs run.
+    :param broker: JobBroker or path to its database
+    :param name: name to report this worker's throughput under, defaults to HOST:PID
+    :param num_cores: number of concurrent conversions. Defaults to half the cores.
+    :param lease: seconds a job is held for before another worker may take it
+    :param interval: seconds between checks for new jobs while the queue is empty
+    :return: number of jobs completed
+    """
+    broker = broker if isinstance(broker, JobBroker) else JobBroker(broker)
+    name = name or '{}:{}'.format(socket.gethostname(), os.getpid())
+    workers = _pool_size(num_cores)
+
+    leased = {}  # future -> BrokerJob
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def renew_leases():
+        while not stop.wait(lease / 3):
+            with lock:
+                job_ids = [job.id for job in leased.values()]
+            if job_ids:
+                broker.renew(job_ids, name, lease)
+
+    t = threading.Thread(target=renew_leases)
+    t.daemon = True
+    t.start()
+
+    completed = 0
+    print('Worker {} waiting for jobs from "{}"...'.format(name, broker.path))
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            while True:
+                while len(leased) < workers:
+                    job = broker.lease(name, lease)
+                    if job is None:
+                        break
+                    settings = dict(job.settings)
+                    if settings.get('lame_args') is not None:
+                        settings['lame_args'] = tuple(settings['lame_args'])
+                    future = pool.submit(_convert_job, job.source, job.dest,
+                                         verbose=verbose, submitted=time.time(),
+                                         **settings)
+                    with lock:
+                        leased[future] = job
+                if not leased:
+                    if broker.finished():
+                        break
+                    time.sleep(interval)
+                    continue
+                done, _ = wait(list(leased), timeout=interval,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    with lock:
+                        job = leased.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = JobResult(job.source, job.dest, messages=[str(e)])
+                    for message in result.messages:
+                        print(message)
+                    if not result.ok:
+                        warnings.warn('error converting {}'.format(job.source))
+                    broker.complete(job.id, name, result)
+                    completed += 1
+    finally:
+        stop.set()
+        broker.close()
+    print('Worker {} finished {} jobs.'.format(name, completed))
+    return completed
+
+
+def _pool_size(num_cores):
+    """number of worker processes for a num_cores setting, see convert()"""
+    if isinstance(num_cores, str) and num_cores.lower() == 'auto':
+        return cpu_count()
+    return int(num_cores) if num_cores else max(cpu_count() // 2, 1)
+
+
+def _ignore_interrupt():
+    """lets the watching process handle ctrl-c, and wait for running conversions"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def parse_replacement(replacement):
+    """splits a sed style "s/pat/repl/" substitution into (compiled pat, repl)"""
+    if not replacement.startswith('s'):
+        raise ValueError('replacement string must start with "s[SEPERATOR_CHAR]"')
+    sep = replacement[1]
+    if replacement.count(sep) != 3:
+        raise ValueError("replacement string must be in sed format. eg:'s/pat/repl/"
+                         " (no flags)'")
+    pat, repl = replacement.split(sep)[1:3]
+    return re.compile(pat), repl
 
 
 def generate_outputs(targets,
@@ -208,7 +1455,11 @@ def generate_outputs(targets,
                      clone=False,
                      recursive=False,
                      folder_suffix=None,
-                     sub=None):
+                     sub=None,
+                     profiles=None,
+                     index=None,
+                     changed=None,
+                     on_clone=None):
     """
     Takes in a list of targets and generates tuples containing the apropriate
     source/destination for each folder to be cloned and flac file to be converted.
@@ -218,80 +1469,192 @@ def generate_outputs(targets,
     :param clone: whether or not to clone the extra files in the source directories
     and maintain file structure
     :param recursive: Whether or not to search directories recursivly
-    :return:tuple in format ([(folder_source, folder_dest)...], [(flac_source, dest)])
+    :param profiles: list of output Profiles. With more than one, each profile gets its
+    own output tree: "output/NAME" or cloned folders suffixed with " [NAME]", and every
+    dest below is a tuple with one path per profile.
+    :param index: optional DirectoryIndex to list folders with
+    :param changed: absolute paths of flacs to use instead of searching the target
+    folders. Only those inside a target folder (directly, unless recursive) are used.
+    :param on_clone: called with (file, new_file) for each non-flac file of a cloned
+    folder while it is searched for flacs, see clone_walk(). Without it, cloning is
+    left to the caller.
+    :return:tuple in format ([(folder_source, folder_dest)...], files) where files is
+    a generator of (flac_source, dest) tuples that searches folders lazily
     """
     is_iter = True if iter(targets) is iter(targets) else False
     folders = []
-    files = []
+    sources = []
     for target in targets:
         if os.path.isdir(target):
             if clone:
                 folders.append(os.path.abspath(target))
             else:
-                files += find_flacs(target, recursive=recursive)
+                sources.append((target, True))
         else:
-            files.append(os.path.abspath(target))
+            if not target_is_valid(target):
+                warnings.warn(
+                    ('The target "{}" could not be found or is not a ".flac" file. '
+                     'Skipping...').format(target))
+                continue
+            sources.append((os.path.abspath(target), False))
+    several = not is_iter and len(targets) > 1
 
     output = os.path.abspath(output) if output else None
+    folder_suffix = folder_suffix if folder_suffix else ''
 
-    if output:
-        files = [(f, get_output_path(output, f, sub=sub)) for f in files]
+    # (output, folder_suffix, extension) for each output tree
+    if profiles is not None and len(profiles) > 1:
+        if not output and not clone:
+            raise ValueError('multiple profiles need an output folder or cloning')
+        variants = [(os.path.join(output, p.name) if output else None,
+                     folder_suffix if output else '{} [{}]'.format(folder_suffix, p.name),
+                     p.extension) for p in profiles]
     else:
-        files = [(f, get_output_path(None, f, sub=sub)) for f in files]
+        extension = profiles[0].extension if profiles else '.mp3'
+        variants = [(output, folder_suffix, extension)]
+    name = profiles[0].name if profiles and len(profiles) == 1 else 'MP3'
 
-    folder_suffix = folder_suffix if folder_suffix else ''
     folder_targets = []
     for folder in folders:
-        if output:
-            if not is_iter and len(targets) > 1:
-                output_folder = os.path.join(output, os.path.basename(folder))
+        output_folders = tuple(
+            _output_folder(folder, out, several, sub, suffix, name)
+            for out, suffix, _ in variants)
+        folder_targets.append(
+            (folder, output_folders if len(variants) > 1 else output_folders[0]))
+
+    def search(folder):
+        if changed is None:
+            return find_flacs(folder, recursive=recursive, index=index)
+        return [f for f in changed
+                if f.endswith('.flac') and _in_folder(f, folder, recursive)]
+
+    mappers = [PathMapper(sub, extension=ext) for _, _, ext in variants]
+
+    def files():
+        for target, is_dir in sources:
+            if is_dir:
+                flacs = search(target)
             else:
-                output_folder = output
-            if sub:
-                pat, repl = sub
-                output_folder = re.sub(pat, repl, output_folder)
-            if folder_suffix:
-                output_folder += folder_suffix
-        else:
-            folder_name_modified = False
-            if sub:
-                pat, repl = sub
-                output_folder = re.sub(pat, repl, folder)
-                if output_folder != folder:
-                    folder_name_modified = True
+                flacs = (target, )
+            for f in flacs:
+                dests = tuple(mapper.map(out, f)
+                              for mapper, (out, _, _) in zip(mappers, variants))
+                yield f, dests if len(variants) > 1 else dests[0]
+
+        for folder, output_folders in folder_targets:
+            preserve_from = None if not recursive else folder
+            if len(variants) == 1:
+                output_folders = (output_folders, )
+            if on_clone is not None and changed is None:
+                flacs = clone_walk(folder, output_folders, recursive=recursive,
+                                   index=index, on_file=on_clone)
             else:
-                output_folder = folder
+                flacs = search(folder)
+            for f in flacs:
+                dests = tuple(
+                    mapper.map(out, f, preserve_from)
+                    for mapper, out in zip(mappers, output_folders))
+                yield f, dests if len(variants) > 1 else dests[0]
+
+    return folder_targets, files()
 
-            if folder_suffix:
-                output_folder = '{}{}'.format(output_folder, folder_suffix)
-                folder_name_modified = True
 
-            if not folder_name_modified:  # output folder must not be same as folder
-                output_folder = '{} [MP3]'.format(folder)
+def _output_folder(folder, output, several, sub, folder_suffix, name='MP3'):
+    """works out where a cloned folder should go, see generate_outputs()"""
+    if output:
+        if several:
+            output_folder = os.path.join(output, os.path.basename(folder))
+        else:
+            output_folder = output
+        if sub:
+            pat, repl = sub
+            output_folder = re.sub(pat, repl, output_folder)
+        if folder_suffix:
+            output_folder += folder_suffix
+    else:
+        folder_name_modified = False
+        if sub:
+            pat, repl = sub
+            output_folder = re.sub(pat, repl, folder)
+            if output_folder != folder:
+                folder_name_modified = True
+        else:
+            output_folder = folder
 
-        folder_targets.append((folder, output_folder))
-        additional_files = find_flacs(folder, recursive=recursive)
-        preserve_from = None if not recursive else folder
-        files += [(f, get_output_path(output_folder, f, preserve_from, sub))
-                  for f in additional_files]
+        if folder_suffix:
+            output_folder = '{}{}'.format(output_folder, folder_suffix)
+            folder_name_modified = True
 
-    return folder_targets, files
+        if not folder_name_modified:  # output folder must not be same as folder
+            output_folder = '{} [{}]'.format(folder, name)
+    return output_folder
 
 
-def get_output_path(output, file_path, preserve_from=None, sub=None):
-    """helper function to convert a target filepath into the correct output"""
-    output = output if output else os.path.dirname(file_path)
-    f_name, _, _ = file_path.rpartition('.flac')
-    if preserve_from is not None and preserve_from not in file_path:
-        raise ValueError('"{}" is not in the file path "{}". Cannot preserve recursive '
-                         'folder structure'.format(preserve_from, file_path))
-    new_base = preserve_from if preserve_from else os.path.dirname(file_path)
-    f_name = f_name.replace(new_base, output)
+def get_output_path(output, file_path, preserve_from=None, sub=None, extension='.mp3'):
+    """helper function to convert a target filepath into the correct output. See
+    PathMapper for mapping many files."""
+    folder, name = os.path.split(file_path)
+    if name.endswith('.flac'):
+        name = name[:-len('.flac')]
     if sub:
         pat, repl = sub
-        f_name = os.path.join(os.path.dirname(f_name),
-                              re.sub(pat, repl, os.path.basename(f_name)))
-    return '{}.mp3'.format(f_name)
+        name = re.sub(pat, repl, name)
+    return os.path.join(PathMapper._map_folder(output, folder, preserve_from),
+                        name + extension)
+
+
+class PathMapper(object):
+    """
+    Maps flac paths to output paths. The output folder of each source folder is worked
+    out once with os.path.relpath and remembered, so each file only costs the
+    replacement on its own name, which is compiled once.
+    :param sub: (pattern, repl) replacement for file names, see parse_replacement()
+    :param extension: extension of the output files
+    :param cache_size: number of source folders to remember
+    """
+
+    def __init__(self, sub=None, extension='.mp3', cache_size=PATH_CACHE_FOLDERS):
+        self.pattern, self.repl = (re.compile(sub[0]), sub[1]) if sub else (None, None)
+        self.extension = extension
+        self._output_prefix = functools.lru_cache(maxsize=cache_size)(self._map_prefix)
+
+    def map(self, output, file_path, preserve_from=None):
+        """
+        :param output: folder for the output, or None to put it next to file_path
+        :param preserve_from: folder whose structure below it is recreated in output
+        :return: the output path of file_path
+        """
+        if os.altsep is None:
+            folder, _, name = file_path.rpartition(os.sep)
+            folder = folder or file_path[:len(file_path) - len(name)]
+        else:
+            folder, name = os.path.split(file_path)
+        if name.endswith('.flac'):
+            name = name[:-len('.flac')]
+        if self.pattern is not None:
+            name = self.pattern.sub(self.repl, name)
+        return self._output_prefix(output, folder, preserve_from) + name + self.extension
+
+    @classmethod
+    def _map_prefix(cls, output, folder, preserve_from):
+        """the output folder as a prefix for names to be added to"""
+        return os.path.join(cls._map_folder(output, folder, preserve_from), '')
+
+    @staticmethod
+    def _map_folder(output, folder, preserve_from):
+        if not output:
+            return folder
+        if preserve_from is None:
+            return output
+        base = os.path.join(preserve_from, '')
+        if folder.startswith(base) and os.pardir not in folder:
+            # already normalised, as found by find_flacs(), so relpath isn't needed
+            return os.path.join(output, folder[len(base):])
+        relative = os.path.relpath(folder or os.curdir, preserve_from)
+        if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+            raise ValueError('"{}" is not in the folder "{}". Cannot preserve recursive '
+                             'folder structure'.format(folder, preserve_from))
+        return output if relative == os.curdir else os.path.join(output, relative)
 
 
 def target_is_valid(target):
@@ -304,38 +1667,309 @@ def target_is_valid(target):
         return False
 
 
-def find_flacs(folder, recursive):
-    if recursive:
-        all_files = []
-        for root, dirs, files in os.walk(folder):
-            for f in files:
-                all_files.append(os.path.join(root, f))
+def find_flacs(folder, recursive, index=None):
+    """generator yielding the absolute path of each flac file in folder as it is
+    found. Folders are listed through index if one is given."""
+    pending = [os.path.abspath(folder)]
+    while pending:
+        current = pending.pop()
+        subfolders = []
+        for name, kind in list_folder(current, index):
+            if kind == 'd':
+                subfolders.append(os.path.join(current, name))
+            elif kind == 'f' and name.endswith('.flac'):
+                yield os.path.join(current, name)
+        if recursive:
+            pending.extend(reversed(subfolders))
 
-        flacs = [os.path.abspath(f) for f in all_files if f.endswith('.flac')]
-        return flacs
-    else:
-        return [
-            os.path.abspath(os.path.join(folder, f)) for f in os.listdir(folder)
-            if f.endswith('.flac')
-        ]
 
+def clone_walk(source, dests, recursive=False, index=None, on_file=None):
+    """
+    generator yielding the absolute path of each flac in source like find_flacs(),
+    while creating the folders of a clone of source in each of dests and calling
+    on_file(file, new_file) for every other file, so the tree is only listed once and
+    the copies can start before the walk is done. See prepare_clone().
+    """
+    pending = [(os.path.abspath(source), tuple(dests))]
+    while pending:
+        current, new_folders = pending.pop()
+        for new_folder in new_folders:
+            if not os.path.exists(new_folder):
+                os.makedirs(new_folder)
+        subfolders = []
+        for name, kind in list_folder(current, index):
+            path = os.path.join(current, name)
+            if kind == 'd' and recursive:
+                subfolders.append(
+                    (path, tuple(os.path.join(f, name) for f in new_folders)))
+            elif kind == 'f' and name.endswith('.flac'):
+                yield path
+            elif kind == 'f' and on_file is not None:
+                for new_folder in new_folders:
+                    on_file(path, os.path.join(new_folder, name))
+        pending.extend(reversed(subfolders))
 
-@contextlib.contextmanager
-def non_uni_files(source, dest):
-    """context manager to copy files into non-unicode namespace, copy the new dest to
-    the correct place and cleanup afterward"""
-    tempdir = tempfile.mkdtemp()
-    temp_source = os.path.join(tempdir, '{}.flac'.format(hash(source)))
-    temp_dest = os.path.join(tempdir, '{}.mp3'.format(hash(dest)))
-    shutil.copy2(source, temp_source)
-    try:
-        yield (temp_source, temp_dest)
-    except:
-        raise
-    else:
-        if os.path.exists(temp_dest):
-            shutil.copy2(temp_dest, dest)
-    finally:
+
+def _in_folder(path, folder, recursive):
+    """checks if path is inside folder, or directly inside it if not recursive"""
+    relative = os.path.relpath(path, folder)
+    if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+        return False
+    return recursive or os.sep not in relative
+
+
+def list_folder(folder, index=None):
+    """
+    lists the entries of a folder, taking the type of each from the listing itself
+    rather than stat'ing every entry.
+    :param index: optional DirectoryIndex to use a cached listing from
+    :return: list of (name, kind) where kind is "d" for folders (not including links
+    to folders), "f" for files and "" for anything else.
+    """
+    if index is not None:
+        return index.entries(folder)
+    entries = []
+    with contextlib.closing(os.scandir(folder)) as listing:
+        for entry in listing:
+            if entry.is_dir(follow_symlinks=False):
+                kind = 'd'
+            elif entry.is_file():
+                kind = 'f'
+            else:
+                kind = ''
+            entries.append((entry.name, kind))
+    return entries
+
+
+class ReadAhead(object):
+    """
+    reads whole files into memory on a few threads, ahead of the conversions that need
+    them. At most budget bytes are held at a time, so a few sequential readers take
+    the place of every conversion seeking around the source disk at once.
+
+    Contents handed to another process are pickled, so it holds a second copy until
+    the parent's is released. copies is how many times over each file is counted
+    against the budget to account for that.
+    """
+
+    def __init__(self, budget, readers=1, copies=1):
+        self.budget = budget
+        self.copies = copies
+        self._held = 0
+        self._available = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=max(int(readers), 1))
+
+    def read(self, path):
+        """
+        waits for room in the budget for path, then starts reading it.
+        :return: (future of the contents of path, bytes reserved), the reservation must
+        be given back with release() once the contents are no longer needed
+        """
+        try:
+            size = os.path.getsize(path) * self.copies
+        except OSError:
+            size = 0
+        with self._available:
+            # a file larger than the whole budget is read once nothing else is held
+            self._available.wait_for(
+                lambda: not self._held or self._held + size <= self.budget)
+            self._held += size
+        return self._pool.submit(self._read, path), size
+
+    @staticmethod
+    def _read(path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def release(self, size):
+        with self._available:
+            self._held -= size
+            self._available.notify_all()
+
+    def close(self):
+        self._pool.shutdown()
+
+
+class DirectoryIndex(object):
+    """
+    sqlite cache of folder listings, keyed on each folder's mtime.
+
+    Adding, removing or renaming anything in a folder updates its mtime, so a folder
+    with the same mtime as its cached listing can be skipped with a single stat
+    instead of being listed again, which matters on network filesystems.
+    """
+
+    def __init__(self, path, commit_every=1000):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._commit_every = commit_every
+        self._uncommitted = 0
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS folders ('
+                             'path TEXT PRIMARY KEY, mtime REAL, entries TEXT)')
+
+    def entries(self, folder):
+        """the entries of folder, see list_folder()"""
+        mtime = os.stat(folder).st_mtime
+        with self._lock:
+            row = self._db.execute('SELECT mtime, entries FROM folders WHERE path = ?',
+                                   (folder, )).fetchone()
+        if row is not None and row[0] == mtime:
+            return [tuple(entry) for entry in json.loads(row[1])]
+
+        entries = list_folder(folder)
+        if time.time() - mtime > INDEX_RACY_SECONDS:
+            with self._lock:
+                self._db.execute('INSERT OR REPLACE INTO folders VALUES (?, ?, ?)',
+                                 (folder, mtime, json.dumps(entries)))
+                self._uncommitted += 1
+                if self._uncommitted >= self._commit_every:
+                    self._db.commit()
+                    self._uncommitted = 0
+        return entries
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+
+class InotifyWatcher(object):
+    """
+    reports files created or written to in folders using linux's inotify. New
+    subfolders are watched as they appear when recursive.
+    """
+
+    def __init__(self, folders, recursive):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._recursive = recursive
+        self._folders = {}
+        try:
+            for folder in folders:
+                self._add(folder, None)
+        except OSError:
+            self.close()
+            raise
+
+    def _add(self, folder, found):
+        """watches folder, and its subfolders if recursive, adding the files already
+        in them to found unless it is None"""
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(folder), WATCH_MASK)
+        if wd < 0:
+            errno_ = ctypes.get_errno()
+            raise OSError(errno_, 'could not watch "{}": {}'.format(
+                folder, os.strerror(errno_)))
+        self._folders[wd] = folder
+        if not self._recursive and found is None:
+            return
+        for name, kind in list_folder(folder):
+            path = os.path.join(folder, name)
+            if kind == 'd' and self._recursive:
+                self._add(path, found)
+            elif kind == 'f' and found is not None:
+                found.append(path)
+
+    def changes(self, timeout):
+        """waits up to timeout seconds for events, returning the paths of files that
+        were created or written to"""
+        found = []
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return found
+        data = os.read(self._fd, 1 << 16)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = struct.unpack_from('iIII', data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+            offset += 16 + length
+            if mask & IN_IGNORED:
+                self._folders.pop(wd, None)
+            folder = self._folders.get(wd)
+            if folder is None or not name:
+                continue
+            path = os.path.join(folder, os.fsdecode(name))
+            if not mask & IN_ISDIR:
+                found.append(path)
+            elif self._recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                try:
+                    self._add(path, found)
+                except OSError:  # already removed again
+                    pass
+        return found
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher(object):
+    """
+    reports files added to folders by comparing their listings. Only folders whose
+    mtime has changed are listed again.
+    """
+
+    def __init__(self, folders, recursive):
+        self._roots = folders
+        self._recursive = recursive
+        self._listings = {}
+        self._scan(None)
+
+    def _scan(self, found):
+        listings = {}
+        pending = list(self._roots)
+        while pending:
+            folder = pending.pop()
+            known = self._listings.get(folder)
+            try:
+                mtime = os.stat(folder).st_mtime
+                unchanged = known is not None and known[0] == mtime
+                entries = known[1] if unchanged else list_folder(folder)
+            except OSError:  # removed since it was listed
+                continue
+            if found is not None and not unchanged:
+                old = set(known[1]) if known is not None else set()
+                found.extend(os.path.join(folder, name) for name, kind in entries
+                             if kind == 'f' and (name, kind) not in old)
+            # a folder changed within the resolution of its mtime could change again
+            # without its mtime changing
+            recent = time.time() - mtime <= INDEX_RACY_SECONDS
+            listings[folder] = (None if recent else mtime, entries)
+            if self._recursive:
+                pending.extend(os.path.join(folder, name) for name, kind in entries
+                               if kind == 'd')
+        self._listings = listings
+
+    def changes(self, timeout):
+        """waits timeout seconds, then returns the paths of files added since the last
+        call"""
+        time.sleep(timeout)
+        found = []
+        self._scan(found)
+        return found
+
+    def close(self):
+        pass
+
+
+@contextlib.contextmanager
+def non_uni_files(source, dest):
+    """context manager to copy files into non-unicode namespace, copy the new dest to
+    the correct place and cleanup afterward"""
+    tempdir = tempfile.mkdtemp()
+    temp_source = os.path.join(tempdir, '{}.flac'.format(hash(source)))
+    temp_dest = os.path.join(tempdir, '{}.mp3'.format(hash(dest)))
+    shutil.copy2(source, temp_source)
+    try:
+        yield (temp_source, temp_dest)
+    except:
+        raise
+    else:
+        if os.path.exists(temp_dest):
+            shutil.copy2(temp_dest, dest)
+    finally:
         shutil.rmtree(tempdir)
 
 
@@ -373,11 +2007,19 @@ def _do_convert(source,
                 cbr=None,
                 lame_args=None,
                 overwrite=False,
-                nice_val=10):
-    """Convert flacs to mp3 V0 using lame and Copies tags from flac to new MP3."""
-    new_path = os.path.dirname(dest)
-    if not os.path.exists(new_path):
-        os.makedirs(new_path)
+                nice_val=10,
+                decoder='flac',
+                tag_args=(),
+                metrics=None,
+                data=None):
+    """Convert flacs to mp3 V0 using lame and Copies tags from flac to new MP3.
+    :param tag_args: extra lame arguments for writing tags, see lame_tag_args()
+    :param data: contents of source if it has already been read, see ReadAhead
+    :param metrics: optional dict to be filled with the exit codes of flac and lame
+    and the cpu seconds spent decoding and encoding
+    """
+    metrics = {} if metrics is None else metrics
+    _make_parent(dest)
 
     if os.path.exists(dest) and not overwrite:
         warnings.warn('"{}" already exists! skipping...'.format(dest))
@@ -385,109 +2027,2311 @@ def _do_convert(source,
 
     # print('\nConverting: ', source, ' : ', dest)
 
+    set_nice = _nice_fn(nice_val)
+
+    args = ('lame', '--silent') + lame_settings(vbr, cbr, lame_args) + tuple(tag_args)
+    args += ('-', dest)
+
+    sound_file = None
+    if decoder == 'soundfile':
+        sound_file = _open_pcm(io.BytesIO(data) if data is not None else source)
+    if sound_file is not None:
+        # decode in-process, streaming the pcm straight into lame
+        ps_lame = subprocess.Popen(args,
+                                   preexec_fn=set_nice,
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL)
+        decoded = True
+        start = time.process_time()
+        try:
+            _write_wav(sound_file, ps_lame.stdin)
+        except RuntimeError:
+            decoded = False
+        except (IOError, OSError):
+            pass  # lame quit early, its return code will say why
+        finally:
+            metrics['decode_cpu'] = time.process_time() - start
+            sound_file.close()
+            try:
+                ps_lame.stdin.close()
+            except (IOError, OSError):
+                pass
+        start = _children_cpu_time()
+        metrics['lame_exit'] = ps_lame.wait()
+        metrics['encode_cpu'] = _children_cpu_time() - start
+        if metrics['lame_exit'] != 0 or not decoded:
+            return source, None
+        return source, dest
+
     # uses flac to decode and pipe it's output into lame with the correct
     # arguments.
-    if sys.platform == 'win32':  # preexe/nice is not supported on windows
-        set_nice = None
-    else:
-        def set_nice():
-            os.nice(nice_val)
-
     flac_args = ('flac', '-d', '-c', '-s')
     try:
-        ps_flac = subprocess.Popen(flac_args + (source, ),
+        ps_flac = subprocess.Popen(flac_args + (source if data is None else '-', ),
                                    preexec_fn=set_nice,
+                                   stdin=None if data is None else subprocess.PIPE,
                                    stdout=subprocess.PIPE,
                                    stderr=subprocess.DEVNULL)
     except OSError:
         raise OSError("FLAC executible is not installed or not in path!")
+    if data is not None:
+        feeder = threading.Thread(target=_feed, args=(ps_flac.stdin, data))
+        feeder.daemon = True
+        feeder.start()
+
+    # this worker only has these children, so their cpu time can be told apart by
+    # checking it after reaping each one
+    start = _children_cpu_time()
+    ps_lame = subprocess.call(args,
+                              preexec_fn=set_nice,
+                              stdin=ps_flac.stdout,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    encoded = _children_cpu_time()
+    ps_flac.stdout.close()
+    ps_flac.wait()
+    metrics.update({
+        'flac_exit': ps_flac.returncode,
+        'lame_exit': ps_lame,
+        'encode_cpu': encoded - start,
+        'decode_cpu': _children_cpu_time() - encoded,
+    })
+    if ps_lame != 0 or ps_flac.returncode != 0:
+        return source, None
+    return source, dest
 
 
-# lame arguments hierarchy goes lameargs > CBR > VBR.
+def _split_convert(source,
+                   dest,
+                   info,
+                   chunk_length,
+                   vbr=0,
+                   cbr=None,
+                   lame_args=None,
+                   nice_val=10,
+                   metrics=None,
+                   threads=None,
+                   **kwargs):
+    """
+    Encodes a long flac as chunks of about chunk_length seconds in parallel and joins
+    them into one gapless mp3.
 
-    if lame_args is None:
-        if cbr is None:
-            args = ['lame', '-', dest, '-V', str(vbr), '--silent']
-            ps_lame = subprocess.call(args,
-                                      preexec_fn=set_nice,
-                                      stdin=ps_flac.stdout,
-                                      stdout=subprocess.DEVNULL,
-                                      stderr=subprocess.DEVNULL)
+    Each chunk starts on a frame boundary of the whole track and is encoded with
+    CHUNK_OVERLAP_FRAMES of audio either side, which are dropped again, so the frames
+    kept from each chunk are encoded as they would be in one pass. The bit reservoir
+    is disabled so that no frame depends on the one before it. The LAME info frame
+    written for the first chunk is rewritten for the whole track, with its frame
+    count, seek table, padding and crcs. Chunks are always decoded with the flac binary.
+    :param info: StreamInfo of source
+    :param threads: chunks to encode at once, defaults to the number of cpus
+    :return: (source, dest), (source, None) if encoding failed, or None if lame
+    resampled the audio and the flac has to be converted in one pass instead
+    """
+    metrics = {} if metrics is None else metrics
+    _make_parent(dest)
+    set_nice = _nice_fn(nice_val)
+    settings = ('lame', '--silent', '--nores') + lame_settings(vbr, cbr, lame_args)
+    frame_samples = 1152 if info.sample_rate >= 32000 else 576
+    track_frames = -(-info.total_samples // frame_samples)
+    chunk_frames = max(int(chunk_length * info.sample_rate) // frame_samples, 1)
+    starts = list(range(0, track_frames, chunk_frames))
+
+    def encode_chunk(index):
+        """encodes chunk index to a temporary file, only the first one gets an info
+        frame. :return: (path, exit codes)"""
+        first = max(starts[index] - CHUNK_OVERLAP_FRAMES, 0) * frame_samples
+        if index + 1 < len(starts):
+            until = (starts[index + 1] + CHUNK_OVERLAP_FRAMES) * frame_samples
+            until = min(until, info.total_samples)
         else:
-            ps_lame = subprocess.call(('lame', '-', dest) + ('-b', str(cbr), '--silent'),
-                                      preexec_fn=set_nice,
-                                      stdin=ps_flac.stdout,
-                                      stderr=subprocess.DEVNULL,
-                                      stdout=subprocess.DEVNULL)
-    else:
-        ps_lame = subprocess.call(('lame', '-', dest, '--silent') + lame_args,
-                                  preexec_fn=set_nice,
-                                  stdin=ps_flac.stdout,
-                                  stderr=subprocess.DEVNULL,
-                                  stdout=subprocess.DEVNULL)
-    ps_flac.wait()
+            until = info.total_samples
+        fd, path = tempfile.mkstemp(prefix='chunk', suffix=TEMP_SUFFIX,
+                                    dir=os.path.dirname(dest))
+        os.close(fd)
+        ps_flac = subprocess.Popen(('flac', '-d', '-c', '-s', '--skip={}'.format(first),
+                                    '--until={}'.format(until), source),
+                                   preexec_fn=set_nice,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.DEVNULL)
+        args = settings + (('-t', ) if index else ()) + ('-', path)
+        lame_exit = subprocess.call(args,
+                                    preexec_fn=set_nice,
+                                    stdin=ps_flac.stdout,
+                                    stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.DEVNULL)
+        ps_flac.stdout.close()
+        return path, ps_flac.wait(), lame_exit
+
+    start = _children_cpu_time()
+    workers = max(min(len(starts), threads or cpu_count()), 1)
+    chunk_pool = ThreadPoolExecutor(max_workers=workers)
+    chunks = [chunk_pool.submit(encode_chunk, index) for index in range(len(starts))]
+    template = None
+    offsets = array.array('q')
+    music_crc = 0
+    joined = True
+    try:
+        with open(dest, 'wb') as out:
+            # the chunks are joined in order while the later ones are still encoding
+            for index, chunk in enumerate(chunks):
+                path, flac_exit, lame_exit = chunk.result()
+                metrics['flac_exit'] = max(metrics.get('flac_exit', 0), flac_exit)
+                metrics['lame_exit'] = max(metrics.get('lame_exit', 0), lame_exit)
+                if flac_exit or lame_exit:
+                    joined = False
+                    break
+                with open(path, 'rb') as f:
+                    data = f.read()
+                frames = list(_mp3_frames(data))
+                if not frames or frames[0][2] != info.sample_rate:
+                    return None
+                if index == 0:
+                    offset, length, _ = frames.pop(0)
+                    template = data[offset:offset + length]
+                    if _xing_offset(template) is None:
+                        return None
+                    out.write(template)
+                else:
+                    # chunks near the start begin at the first frame instead
+                    del frames[:min(CHUNK_OVERLAP_FRAMES, starts[index])]
+                if index + 1 < len(starts):
+                    keep = starts[index + 1] - starts[index]
+                    del frames[keep:]
+                    if len(frames) < keep:
+                        return None
+                if not frames:
+                    return None
+                kept = data[frames[0][0]:frames[-1][0] + frames[-1][1]]
+                position = out.tell()
+                offsets.extend(position + offset - frames[0][0]
+                               for offset, _, _ in frames)
+                music_crc = _crc16(kept, music_crc)
+                out.write(kept)
+            stream_bytes = out.tell()
+            if joined:
+                out.seek(0)
+                out.write(_lame_info_frame(template, offsets, stream_bytes,
+                                           frame_samples, info.total_samples,
+                                           music_crc))
+    finally:
+        chunk_pool.shutdown()
+        for chunk in chunks:
+            if chunk.exception() is None and os.path.exists(chunk.result()[0]):
+                os.remove(chunk.result()[0])
+        metrics['encode_cpu'] = _children_cpu_time() - start
+    if not joined:
+        return source, None
     return source, dest
 
 
-def copy_tags(source, target, verbose=False, print_queue=None):
-    """Uses mutagen to duplicate valid tags from flac to MP3"""
+def _mp3_frames(data):
+    """generator yielding (offset, length, sample rate) of each mpeg audio layer III
+    frame in data, which must start with a frame. Stops at anything else."""
+    offset = 0
+    while offset + 4 <= len(data):
+        b1, b2 = data[offset + 1], data[offset + 2]
+        version = (b1 >> 3) & 0x3
+        bitrate_index = b2 >> 4
+        rate_index = (b2 >> 2) & 0x3
+        if (data[offset] != 0xFF or b1 & 0xE0 != 0xE0 or version == 1 or
+                (b1 >> 1) & 0x3 != 1 or bitrate_index in (0, 15) or rate_index == 3):
+            return
+        mpeg1 = version == 3
+        sample_rate = MP3_SAMPLE_RATES[rate_index] >> (0 if mpeg1 else 3 - version)
+        bitrate = MP3_BITRATES[0 if mpeg1 else 1][bitrate_index] * 1000
+        length = (144 if mpeg1 else 72) * bitrate // sample_rate + ((b2 >> 1) & 0x1)
+        yield offset, length, sample_rate
+        offset += length
+
+
+def _xing_offset(frame):
+    """offset of the Xing/Info tag in an mp3 frame, or None if it doesn't have one"""
+    mpeg1 = (frame[1] >> 3) & 0x3 == 3
+    mono = frame[3] >> 6 == 3
+    offset = 4 + ((17 if mono else 32) if mpeg1 else (9 if mono else 17))
+    if frame[offset:offset + 4] not in (b'Xing', b'Info'):
+        return None
+    return offset
+
+
+def _lame_info_frame(template, offsets, stream_bytes, frame_samples, total_samples,
+                     music_crc):
+    """
+    rewrites a Xing/LAME info frame for a joined stream of audio frames.
+    :param offsets: offset of each audio frame from the start of the info frame
+    :param stream_bytes: length of the info frame and audio frames together
+    :param music_crc: crc16 of the audio frames
+    """
+    frame = bytearray(template)
+    xing = _xing_offset(frame)
+    struct.pack_into('>III', frame, xing + 4, 0xF, len(offsets), stream_bytes)
+    frame[xing + 16:xing + 116] = bytes(
+        min(256 * offsets[len(offsets) * i // 100] // stream_bytes, 255)
+        for i in range(100))
+    lame = xing + 120
+    if frame[lame:lame + 4] == b'LAME':
+        # replaygain was measured on the first chunk only
+        frame[lame + 11:lame + 19] = bytes(8)
+        delay = (frame[lame + 21] << 4) | (frame[lame + 22] >> 4)
+        padding = len(offsets) * frame_samples - delay - total_samples
+        frame[lame + 21:lame + 24] = struct.pack('>I', (delay << 12) | padding)[1:]
+        struct.pack_into('>IH', frame, lame + 28, stream_bytes, music_crc)
+        struct.pack_into('>H', frame, lame + 34, _crc16(frame[:lame + 34]))
+    return bytes(frame)
+
+
+def _crc16(data, crc=0):
+    """crc-16 (polynomial 0x8005, reflected) as used in the LAME tag. Pass the crc of
+    earlier data to continue it."""
+    table = _crc16_table()
+    for byte in bytearray(data):
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+@functools.lru_cache(maxsize=None)
+def _crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+def _feed(stream, data):
+    """writes data to a subprocess's stdin and closes it"""
+    try:
+        stream.write(data)
+    except (IOError, OSError):
+        pass  # the process quit early, its return code will say why
+    finally:
+        try:
+            stream.close()
+        except (IOError, OSError):
+            pass
+
+
+def _make_parent(path):
+    """creates the folder path will go in, if it doesn't exist already"""
+    new_path = os.path.dirname(path)
+    if not os.path.exists(new_path):
+        try:
+            os.makedirs(new_path)
+        except OSError:  # another worker got there first
+            if not os.path.isdir(new_path):
+                raise
+
+
+def _nice_fn(nice_val):
+    """preexec_fn for encoder/decoder processes, setting their nice level"""
+    if sys.platform == 'win32':  # preexe/nice is not supported on windows
+        return None
+
+    def set_nice():
+        os.nice(nice_val)
+
+    return set_nice
+
+
+class JobResult(object):
+    """outcome of a single conversion job, passed back from the worker process"""
+
+    def __init__(self, source, dest, ok=False, messages=None, fingerprint=None,
+                 timings=None):
+        self.source = source
+        self.dest = dest
+        self.ok = ok
+        self.messages = messages if messages is not None else []
+        self.fingerprint = fingerprint
+        self.timings = timings if timings is not None else {}
+        self.exit_codes = {}
+        self.bytes_in = None
+        self.bytes_out = None
+        self.worker = os.getpid()
+        # mp3 in a scratch folder still to be moved to dest, see _convert_job()
+        self.staged = None
+        # dest already existed and was left alone
+        self.skipped = False
+
+    @property
+    def status(self):
+        """the outcome: "ok", "skipped" or "failed"."""
+        if self.skipped:
+            return 'skipped'
+        return 'ok' if self.ok else 'failed'
+
+    @property
+    def error(self):
+        """what went wrong, for a failed job"""
+        if self.status != 'failed':
+            return None
+        return '\n'.join(self.messages) or 'conversion failed'
+
+    def as_dict(self):
+        return {
+            'source': self.source,
+            'dest': self.dest,
+            'ok': self.ok,
+            'status': self.status,
+            'timings': self.timings,
+            'exit_codes': self.exit_codes,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'worker': self.worker,
+        }
+
+
+def _convert_job(source, dest, fingerprint=False, verbose=False, submitted=None,
+                 tagger='lame', overwrite=False, split=None, scratch=None,
+                 art_size=None, art_max_bytes=None, threads=None, **kwargs):
+    """worker process entry point, converts source and copies its tags to the new mp3.
+    The mp3 is written to a temporary file next to dest and only moved into place
+    once it is complete, so an interrupted conversion never leaves a partial dest.
+    :param fingerprint: also return the (size, mtime, hash) of source for the manifest
+    :param submitted: time the job was submitted, to measure time spent queued
+    :param tagger: "lame" to write the tags while encoding, or "mutagen" to add them
+    to the mp3 afterwards
+    :param split: encode flacs longer than this many seconds in parallel chunks
+    :param scratch: folder to encode the mp3 in instead of next to dest. It is left
+    there for the caller to move into place, see JobResult.staged.
+    :param art_size: see read_cover()
+    :param art_max_bytes: see read_cover()
+    :param threads: chunks of a split flac to encode at once, see _split_convert()
+    """
+    result = JobResult(source, dest)
+    start = time.time()
+    if submitted is not None:
+        result.timings['queue_wait'] = start - submitted
+    try:
+        result.bytes_in = os.path.getsize(source)
+    except OSError:
+        pass
+    if os.path.exists(dest) and not overwrite:
+        warnings.warn('"{}" already exists! skipping...'.format(dest))
+        result.skipped = True
+        return result
+    if scratch is None:
+        partial = dest + TEMP_SUFFIX
+    else:
+        fd, partial = tempfile.mkstemp(suffix=os.path.splitext(dest)[1], dir=scratch)
+        os.close(fd)
+    messages = queue.Queue()
+    info = None
+    if split:
+        data = kwargs.get('data')
+        info = flac_streaminfo(io.BytesIO(data) if data is not None else source)
+    if info is None or not info.total_samples or info.duration <= split:
+        info = None
+    tag_args, art_path = None, None
+    if tagger == 'lame' and info is None:
+        tag_args, art_path = lame_tag_args(source, verbose=True, print_queue=messages,
+                                           art_size=art_size, art_max_bytes=art_max_bytes)
+        result.timings['tag'] = time.time() - start
+    metrics = {}
+    start = time.time()
+    try:
+        converted = None
+        if info is not None:
+            converted = _split_convert(source, partial, info, split, metrics=metrics,
+                                       threads=threads, **kwargs)
+        if converted is None:
+            converted = _do_convert(source, partial, overwrite=True,
+                                    tag_args=tag_args or (), metrics=metrics, **kwargs)
+        old, new = converted
+        result.timings['encode'] = time.time() - start
+        for key in ('decode_cpu', 'encode_cpu'):
+            if key in metrics:
+                result.timings[key] = metrics[key]
+        result.exit_codes = {
+            k[:-5]: v
+            for k, v in metrics.items() if k.endswith('_exit')
+        }
+        if not new:
+            return result
+        if tag_args is None:
+            if verbose:
+                messages.put('Conversion done for {}\nCopying tags...'.format(old))
+            start = time.time()
+            copy_tags(old, new, verbose=True, print_queue=messages, art_size=art_size,
+                      art_max_bytes=art_max_bytes)
+            result.timings['tag'] = time.time() - start
+        elif verbose:
+            messages.put('Conversion done for {}'.format(old))
+        if scratch is None:
+            os.replace(partial, dest)
+        else:
+            result.staged = partial
+    finally:
+        if art_path is not None:
+            os.remove(art_path)
+        if result.staged is None and os.path.exists(partial):
+            os.remove(partial)
+        while not messages.empty():
+            result.messages.append(messages.get())
+    result.bytes_out = os.path.getsize(result.staged or dest)
+    if fingerprint:
+        st = os.stat(source)
+        result.fingerprint = (st.st_size, st.st_mtime,
+                              file_hash(source, data=kwargs.get('data')))
+    result.ok = True
+    return result
+
+
+def _cue_job(source, dests, tracks, fingerprint=False, verbose=False, submitted=None,
+             overwrite=False, vbr=0, cbr=None, lame_args=None, nice_val=10,
+             art_size=None, art_max_bytes=None, threads=None, **kwargs):
+    """
+    worker process entry point for a flac image with a cue sheet. Each track is
+    decoded from its range of the image and piped into its own lame, with up to
+    threads tracks encoded at once, so nothing is written to temporary files. Tracks
+    are tagged with copy_tags() using the flac's tags and the track's tags from the
+    cue sheet.
+    :param dests: path of each track's mp3
+    :param tracks: list of CueTracks, see find_cue()
+    :param threads: tracks to encode at once, defaults to the number of cpus
+    """
+    result = JobResult(source, dests)
+    start = time.time()
+    if submitted is not None:
+        result.timings['queue_wait'] = start - submitted
+    if not overwrite and all(os.path.exists(dest) for dest in dests):
+        result.messages.append('"{}" is already split! skipping...'.format(source))
+        result.skipped = True
+        return result
+    info = flac_streaminfo(source)
+    if info is None or not info.total_samples:
+        result.messages.append('could not read the length of "{}"'.format(source))
+        return result
+    result.bytes_in = os.path.getsize(source)
+    messages = queue.Queue()
+    set_nice = _nice_fn(nice_val)
+    settings = ('lame', '--silent') + lame_settings(vbr, cbr, lame_args)
+
+    def encode(track, dest, end):
+        # each track is decoded from its own range of the image straight into lame
+        partial = dest + TEMP_SUFFIX
+        try:
+            ps_flac = subprocess.Popen(('flac', '-d', '-c', '-s',
+                                        '--skip={}'.format(track.start),
+                                        '--until={}'.format(end), source),
+                                       preexec_fn=set_nice,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.DEVNULL)
+            try:
+                lame_exit = subprocess.call(settings + ('-', partial),
+                                            preexec_fn=set_nice,
+                                            stdin=ps_flac.stdout,
+                                            stdout=subprocess.DEVNULL,
+                                            stderr=subprocess.DEVNULL)
+            finally:
+                ps_flac.stdout.close()
+                flac_exit = ps_flac.wait()
+            if flac_exit == 0 and lame_exit == 0:
+                copy_tags(source, partial, verbose=True, print_queue=messages,
+                          tags=track.tags, art_size=art_size,
+                          art_max_bytes=art_max_bytes)
+                os.replace(partial, dest)
+                if verbose:
+                    messages.put('Conversion done for {}'.format(dest))
+            return flac_exit, lame_exit
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+    ends = [track.start for track in tracks[1:]] + [info.total_samples]
+    pending = []
+    for track, dest, end in zip(tracks, dests, ends):
+        if os.path.exists(dest) and not overwrite:
+            messages.put('"{}" already exists! skipping...'.format(dest))
+            continue
+        _make_parent(dest)
+        pending.append((track, dest, end))
+    workers = max(min(len(pending), threads or cpu_count()), 1)
+    with ThreadPoolExecutor(max_workers=workers) as encoders:
+        exits = list(encoders.map(lambda args: encode(*args), pending))
+    while not messages.empty():
+        result.messages.append(messages.get())
+    result.timings['encode'] = time.time() - start
+    result.exit_codes = {
+        'flac': max([flac for flac, _ in exits] or [0]),
+        'lame': max([lame for _, lame in exits] or [0]),
+    }
+    if any(flac or lame for flac, lame in exits):
+        return result
+    result.bytes_out = sum(os.path.getsize(dest) for dest in dests)
+    if fingerprint:
+        st = os.stat(source)
+        result.fingerprint = (st.st_size, st.st_mtime,
+                              file_hash(source, data=kwargs.get('data')))
+    result.ok = True
+    return result
+
+
+async def _convert_async(source, dest, vbr=0, cbr=None, lame_args=None, overwrite=False,
+                         nice_val=10, tagger='lame'):
+    """converts source to dest with asyncio subprocesses, see convert_async(). The
+    flac and lame processes are killed if this is cancelled."""
+    loop = asyncio.get_event_loop()
+    result = JobResult(source, dest)
+    if os.path.exists(dest) and not overwrite:
+        result.skipped = True
+        result.messages.append('"{}" already exists! skipping...'.format(dest))
+        return result
+    result.bytes_in = os.path.getsize(source)
+    messages = queue.Queue()
+    partial = dest + TEMP_SUFFIX
+    processes = []
+    tag_args, art_path = None, None
+    try:
+        start = time.time()
+        if tagger == 'lame':
+            tag_args, art_path = await loop.run_in_executor(None, lame_tag_args, source,
+                                                            True, messages)
+            result.timings['tag'] = time.time() - start
+        _make_parent(dest)
+        set_nice = _nice_fn(nice_val)
+        args = ('lame', '--silent') + lame_settings(vbr, cbr, lame_args)
+        args += tuple(tag_args or ()) + ('-', partial)
+
+        start = time.time()
+        read_fd, write_fd = os.pipe()
+        try:
+            processes.append(await asyncio.create_subprocess_exec(
+                'flac', '-d', '-c', '-s', source, preexec_fn=set_nice, stdout=write_fd,
+                stderr=subprocess.DEVNULL))
+            processes.append(await asyncio.create_subprocess_exec(
+                *args, preexec_fn=set_nice, stdin=read_fd, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL))
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+        flac_exit, lame_exit = await asyncio.gather(*(p.wait() for p in processes))
+        result.timings['encode'] = time.time() - start
+        result.exit_codes = {'flac': flac_exit, 'lame': lame_exit}
+        if flac_exit != 0 or lame_exit != 0:
+            return result
+
+        if tag_args is None:
+            start = time.time()
+            await loop.run_in_executor(None, copy_tags, source, partial, True, messages)
+            result.timings['tag'] = time.time() - start
+        os.replace(partial, dest)
+        result.bytes_out = os.path.getsize(dest)
+        result.ok = True
+    except asyncio.CancelledError:
+        for process in processes:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+        raise
+    except (IOError, OSError) as e:
+        result.messages.append(str(e))
+    finally:
+        if art_path is not None:
+            os.remove(art_path)
+        if os.path.exists(partial):
+            os.remove(partial)
+        while not messages.empty():
+            result.messages.append(messages.get())
+    return result
+
+
+def _duplicate_job(leader_source, leader_dest, source, dest, fingerprint=False,
+                   verbose=False, submitted=None, overwrite=False, art_size=None,
+                   art_max_bytes=None, **kwargs):
+    """
+    worker process entry point for a flac with the same audio as an already converted
+    one. leader_dest is hardlinked to dest if both flacs have the same tags, otherwise
+    it is copied and given the tags of source with copy_tags().
+    """
+    result = JobResult(source, dest)
+    start = time.time()
+    if submitted is not None:
+        result.timings['queue_wait'] = start - submitted
+    try:
+        result.bytes_in = os.path.getsize(source)
+    except OSError:
+        pass
+    if os.path.exists(dest) and not overwrite:
+        warnings.warn('"{}" already exists! skipping...'.format(dest))
+        result.skipped = True
+        return result
+    _make_parent(dest)
+    partial = dest + TEMP_SUFFIX
+    messages = queue.Queue()
+    try:
+        linked = False
+        if same_tags(leader_source, source):
+            try:
+                os.link(leader_dest, partial)
+                linked = True
+            except OSError:  # different filesystems, or no hardlinks
+                pass
+        if not linked:
+            shutil.copyfile(leader_dest, partial)
+        result.timings['copy'] = time.time() - start
+        if verbose:
+            messages.put('{} duplicate of {} for {}'.format(
+                'Linked' if linked else 'Copied', leader_dest, source))
+        if not linked:
+            start = time.time()
+            delete_id3(partial)
+            copy_tags(source, partial, verbose=True, print_queue=messages,
+                      art_size=art_size, art_max_bytes=art_max_bytes)
+            result.timings['tag'] = time.time() - start
+        os.replace(partial, dest)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+        while not messages.empty():
+            result.messages.append(messages.get())
+    result.bytes_out = os.path.getsize(dest)
+    if fingerprint:
+        st = os.stat(source)
+        result.fingerprint = (st.st_size, st.st_mtime,
+                              file_hash(source, data=kwargs.get('data')))
+    result.ok = True
+    return result
+
+
+def _profiles_job(source, dests, profiles=(), fingerprint=False, verbose=False,
+                  submitted=None, overwrite=False, nice_val=10, decoder='flac',
+                  tagger='lame', art_size=None, art_max_bytes=None, **kwargs):
+    """
+    worker process entry point for converting to several profiles at once. source is
+    decoded a single time and the pcm is fed to one encoder per profile, each writing
+    to its own dest. Outputs are written atomically as in _convert_job().
+    """
+    result = JobResult(source, dests)
+    start = time.time()
+    if submitted is not None:
+        result.timings['queue_wait'] = start - submitted
+    try:
+        result.bytes_in = os.path.getsize(source)
+    except OSError:
+        pass
+    pending = []
+    for profile, dest in zip(profiles, dests):
+        if os.path.exists(dest) and not overwrite:
+            warnings.warn('"{}" already exists! skipping...'.format(dest))
+        else:
+            pending.append((profile, dest))
+    if not pending:
+        result.skipped = True
+        return result
+
+    messages = queue.Queue()
+    set_nice = _nice_fn(nice_val)
+    art_paths = []
+    encoders = []
+    metrics = {}
+    try:
+        commands = []
+        for profile, dest in pending:
+            tag_args = ()
+            if profile.encoder == 'opusenc':
+                tag_args, art_path = opus_tag_args(source, True, messages, art_size,
+                                                   art_max_bytes)
+            elif tagger == 'lame':
+                tag_args, art_path = lame_tag_args(source, True, messages, art_size,
+                                                   art_max_bytes)
+            else:
+                art_path = None
+            art_paths.append(art_path)
+            _make_parent(dest)
+            commands.append(profile.command(tag_args or (), dest + TEMP_SUFFIX))
+        result.timings['tag'] = time.time() - start
+
+        start = time.time()
+        for args in commands:
+            encoders.append(
+                subprocess.Popen(args,
+                                 preexec_fn=set_nice,
+                                 stdin=subprocess.PIPE,
+                                 stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.DEVNULL))
+        tee = _Tee([encoder.stdin for encoder in encoders])
+        try:
+            cpu = _children_cpu_time()
+            decoded = _decode(source, tee, decoder, set_nice, metrics)
+            metrics['decode_cpu'] = metrics.get('decode_cpu', 0.0) + (
+                _children_cpu_time() - cpu)
+        finally:
+            tee.close()
+        cpu = _children_cpu_time()
+        for (profile, _), encoder in zip(pending, encoders):
+            metrics[profile.name + '_exit'] = encoder.wait()
+        result.timings['encode_cpu'] = _children_cpu_time() - cpu
+        result.timings['decode_cpu'] = metrics.pop('decode_cpu')
+        result.timings['encode'] = time.time() - start
+        result.exit_codes = {
+            k[:-5]: v
+            for k, v in metrics.items() if k.endswith('_exit')
+        }
+
+        result.ok = decoded
+        for profile, dest in pending:
+            if not decoded or metrics[profile.name + '_exit'] != 0:
+                result.ok = False
+                continue
+            partial = dest + TEMP_SUFFIX
+            if profile.encoder == 'lame' and tagger == 'mutagen':
+                tag_start = time.time()
+                copy_tags(source, partial, verbose=True, print_queue=messages,
+                          art_size=art_size, art_max_bytes=art_max_bytes)
+                result.timings['tag'] += time.time() - tag_start
+            os.replace(partial, dest)
+        if verbose and result.ok:
+            messages.put('Conversion done for {}'.format(source))
+    finally:
+        for encoder in encoders:
+            if encoder.poll() is None:
+                encoder.kill()
+                encoder.wait()
+        for art_path in art_paths:
+            if art_path is not None:
+                os.remove(art_path)
+        for _, dest in pending:
+            if os.path.exists(dest + TEMP_SUFFIX):
+                os.remove(dest + TEMP_SUFFIX)
+        while not messages.empty():
+            result.messages.append(messages.get())
+    if not result.ok:
+        return result
+    result.bytes_out = sum(os.path.getsize(dest) for _, dest in pending)
+    if fingerprint:
+        st = os.stat(source)
+        result.fingerprint = (st.st_size, st.st_mtime,
+                              file_hash(source, data=kwargs.get('data')))
+    return result
+
+
+def _decode(source, stream, decoder='flac', set_nice=None, metrics=None):
+    """
+    decodes source, writing it to stream as a pcm wav.
+    :param metrics: optional dict, filled with the flac exit code, or the cpu seconds
+    spent decoding in-process
+    :return: True if the whole file was decoded
+    """
+    metrics = {} if metrics is None else metrics
+    sound_file = _open_pcm(source) if decoder == 'soundfile' else None
+    if sound_file is not None:
+        start = time.process_time()
+        try:
+            _write_wav(sound_file, stream)
+        except RuntimeError:
+            return False
+        finally:
+            metrics['decode_cpu'] = time.process_time() - start
+            sound_file.close()
+        return True
+
+    try:
+        ps_flac = subprocess.Popen(('flac', '-d', '-c', '-s', source),
+                                   preexec_fn=set_nice,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.DEVNULL)
+    except OSError:
+        raise OSError("FLAC executible is not installed or not in path!")
+    with ps_flac.stdout:
+        for block in iter(functools.partial(ps_flac.stdout.read, PCM_BLOCK_BYTES), b''):
+            stream.write(block)
+    metrics['flac_exit'] = ps_flac.wait()
+    return ps_flac.returncode == 0
+
+
+class _Tee(object):
+    """
+    file-like object copying everything written to it into several pipes. Each pipe is
+    fed by its own thread from a short queue, so encoders can run at their own pace
+    without one slow encoder starving the others. Pipes that break (because their
+    encoder quit) are skipped.
+    """
+
+    def __init__(self, pipes, depth=16):
+        self._queues = []
+        self._threads = []
+        for pipe in pipes:
+            blocks = queue.Queue(depth)
+            t = threading.Thread(target=self._feed, args=(pipe, blocks))
+            t.daemon = True
+            t.start()
+            self._queues.append(blocks)
+            self._threads.append(t)
+
+    @staticmethod
+    def _feed(pipe, blocks):
+        broken = False
+        while True:
+            block = blocks.get()
+            if block is None:
+                break
+            if not broken:
+                try:
+                    pipe.write(block)
+                except (IOError, OSError):
+                    broken = True
+        try:
+            pipe.close()
+        except (IOError, OSError):
+            pass
+
+    def write(self, data):
+        for blocks in self._queues:
+            blocks.put(data)
+
+    def close(self):
+        for blocks in self._queues:
+            blocks.put(None)
+        for t in self._threads:
+            t.join()
+
+
+def _open_pcm(source):
+    """opens source for in-process decoding. Returns None if soundfile is unavailable
+    or cannot handle the file, meaning the flac binary should be used instead."""
+    if soundfile is None:
+        return None
+    try:
+        sound_file = soundfile.SoundFile(source)
+    except RuntimeError:
+        return None
+    if sound_file.channels > 2:  # lame only takes mono or stereo wavs
+        sound_file.close()
+        return None
+    return sound_file
+
+
+def _write_wav(sound_file, stream, block_frames=PCM_BLOCK_FRAMES):
+    """decodes sound_file block by block, writing it to stream as a pcm wav"""
+    bits = 16 if sound_file.subtype in ('PCM_S8', 'PCM_U8', 'PCM_16') else 32
+    stream.write(
+        _wav_header(sound_file.channels, sound_file.samplerate, bits, sound_file.frames))
+    dtype, wav_dtype = ('int16', '<i2') if bits == 16 else ('int32', '<i4')
+    for block in sound_file.blocks(block_frames, dtype=dtype, always_2d=True):
+        stream.write(block.astype(wav_dtype, copy=False).tobytes())
+
+
+def _wav_header(channels, rate, bits, frames):
+    """header of a pcm wav file holding frames samples per channel"""
+    width = bits // 8
+    data_size = min(frames * channels * width, 0xFFFFFFFF - 36)
+    return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', data_size + 36, b'WAVE', b'fmt ',
+                       16, 1, channels, rate, rate * channels * width, channels * width,
+                       bits, b'data', data_size)
+
+
+def lame_settings(vbr=0, cbr=None, lame_args=None):
+    """returns the tuple of quality arguments to pass to lame"""
+    # lame arguments hierarchy goes lameargs > CBR > VBR.
+    if lame_args is not None:
+        return tuple(lame_args)
+    if cbr is not None:
+        return ('-b', str(cbr))
+    return ('-V', str(vbr))
+
+
+def copy_tags(source, target, verbose=False, print_queue=None, tags=None,
+              art_size=None, art_max_bytes=None):
+    """Uses mutagen to duplicate valid tags and the cover art from flac to MP3
+    :param tags: dict of extra tags that replace the flac's, eg: a track's tags from a
+    cue sheet
+    :param art_size: see read_cover()
+    :param art_max_bytes: see read_cover()
+    """
     if print_queue is None:
         print_queue = queue.Queue()
-    try:
-        flac_meta = FLAC(source)
-    except MutagenError:
+    meta = read_flac_metadata(source)
+    if meta is None:
         warnings.warn('Bad metadata on "{}", skipping metadata copy...'.format(source))
         return
+    flac_meta = meta.tags
 
     try:
         mp3_meta = EasyID3(target)
     except MutagenError:
         if verbose:
             print_queue.put('adding id3 header to mp3...')
-        mp3_meta = mutagenFile(target, easy=True)
-        mp3_meta.add_tags()
+        # a new tag rather than mutagen.File(), which can't tell that a partial mp3
+        # without an id3 header or ".mp3" extension is an mp3
+        mp3_meta = EasyID3()
 
     for key in flac_meta.keys():
         # leveling tags causes errors (too quiet on random tracks) so they are omitted
         if key.startswith('replay'):
             if verbose:
-                print_queue.put('skipping leveling key:', key)
+                print_queue.put('skipping leveling key: {}'.format(key))
         else:
             try:
                 mp3_meta[key] = flac_meta[key]
             except EasyID3KeyError:
                 if verbose:
-                    print_queue.put('could not add key: ', key)
-    mp3_meta.save()
+                    print_queue.put('could not add key: {}'.format(key))
+    for key, value in (tags or {}).items():
+        try:
+            mp3_meta[key] = value
+        except EasyID3KeyError:
+            if verbose:
+                print_queue.put('could not add key: {}'.format(key))
+    mp3_meta.save(target)
+
+    # EasyID3 has no key for pictures, so the cover is added as an APIC frame
+    cover = read_cover(source, meta.pictures, art_size, art_max_bytes)
+    if cover is not None:
+        id3 = ID3(target)
+        id3.delall('APIC')
+        id3.add(APIC(encoding=3, mime=cover[0], type=FRONT_COVER, desc='', data=cover[1]))
+        id3.save()
+
+
+def lame_tag_args(source, verbose=False, print_queue=None, art_size=None,
+                  art_max_bytes=None):
+    """
+    Builds the lame arguments to write the flac's tags and cover art as the mp3's
+    id3v2 tag, so they are written once along with the audio instead of rewriting
+    the mp3 afterwards. The same keys are transferred as copy_tags().
+    :return: (args, art_path), where art_path is a temporary file holding the cover
+    art that should be removed once lame is done with it. args is None if the flac's
+    metadata could not be read.
+    :param art_size: see read_cover()
+    :param art_max_bytes: see read_cover()
+    """
+    if print_queue is None:
+        print_queue = queue.Queue()
+    meta = read_flac_metadata(source)
+    if meta is None:
+        warnings.warn('Bad metadata on "{}", skipping metadata copy...'.format(source))
+        return None, None
+    flac_meta = meta.tags
+
+    args = ['--id3v2-only']
+    values = []
+    for key in flac_meta.keys():
+        # leveling tags causes errors (too quiet on random tracks) so they are omitted
+        if key.startswith('replay'):
+            if verbose:
+                print_queue.put('skipping leveling key: {}'.format(key))
+        elif key.lower() in ID3_FRAMES:
+            value = '/'.join(flac_meta[key])
+            args += ['--tv', '{}={}'.format(ID3_FRAMES[key.lower()], value)]
+            values.append(value)
+        elif verbose:
+            print_queue.put('could not add key: {}'.format(key))
+    try:
+        ''.join(values).encode('latin1')
+    except UnicodeEncodeError:
+        args.append('--id3v2-utf16')
+
+    art_path = _write_cover(read_cover(source, meta.pictures, art_size, art_max_bytes))
+    if art_path is not None:
+        args += ['--ti', art_path]
+    return tuple(args), art_path
+
+
+def opus_tag_args(source, verbose=False, print_queue=None, art_size=None,
+                  art_max_bytes=None):
+    """
+    Builds the opusenc arguments to carry over the flac's vorbis comments (which opus
+    uses too) and cover art. See lame_tag_args() for the return value.
+    """
+    if print_queue is None:
+        print_queue = queue.Queue()
+    meta = read_flac_metadata(source)
+    if meta is None:
+        warnings.warn('Bad metadata on "{}", skipping metadata copy...'.format(source))
+        return None, None
+
+    args = []
+    for key, value in meta.tags:
+        if key.lower().startswith('replay'):
+            if verbose:
+                print_queue.put('skipping leveling key: {}'.format(key))
+        else:
+            args += ['--comment', '{}={}'.format(key, value)]
+    art_path = _write_cover(read_cover(source, meta.pictures, art_size, art_max_bytes))
+    if art_path is not None:
+        args += ['--picture', art_path]
+    return tuple(args), art_path
+
+
+FlacMetadata = collections.namedtuple('FlacMetadata', 'tags pictures cuesheet')
+FlacPicture = collections.namedtuple('FlacPicture',
+                                     'type mime width height offset length')
+
+# covers being read by this worker, and processed covers by (hash, size, max bytes)
+_art_readers = threading.BoundedSemaphore(ART_READERS)
+_art_cache = collections.OrderedDict()
+_art_cache_bytes = [0]
+_art_cache_lock = threading.Lock()
+
+
+def read_flac_metadata(source):
+    """
+    reads the vorbis comments of a flac and where its pictures are, without loading
+    the pictures themselves. See read_cover().
+    :return: FlacMetadata, or None if the metadata could not be read. tags is a
+    mutagen VCFLACDict, pictures a list of FlacPictures and cuesheet a mutagen
+    CueSheet or None.
+    """
+    tags, pictures, cuesheet = VCFLACDict(), [], None
+    try:
+        with open(source, 'rb') as f:
+            if not _seek_flac_start(f):
+                return None
+            last = False
+            while not last:
+                header = bytearray(f.read(4))
+                if len(header) < 4:
+                    return None
+                last = bool(header[0] & 0x80)
+                kind = header[0] & 0x7F
+                length = (header[1] << 16) | (header[2] << 8) | header[3]
+                end = f.tell() + length
+                if kind == 4:
+                    tags = VCFLACDict(f.read(length), errors='replace', framing=False)
+                elif kind == 5:
+                    cuesheet = CueSheet(f.read(length))
+                elif kind == 6:
+                    pictures.append(_read_picture_header(f))
+                f.seek(end)
+    except (IOError, OSError, MutagenError, struct.error):
+        return None
+    return FlacMetadata(tags, pictures, cuesheet)
+
 
+def _read_picture_header(f):
+    """reads the fields of a PICTURE block before its data, leaving f at the data"""
+    kind, mime_length = struct.unpack('>II', f.read(8))
+    mime = f.read(mime_length).decode('ascii', 'replace')
+    description_length, = struct.unpack('>I', f.read(4))
+    f.seek(description_length, os.SEEK_CUR)
+    width, height, _, _, length = struct.unpack('>5I', f.read(20))
+    return FlacPicture(kind, mime, width, height, f.tell(), length)
 
-def clone_folder(source, dest, recursive=False):
+
+def read_cover(source, pictures, art_size=None, art_max_bytes=None):
+    """
+    reads the front cover (or first usable picture) of a flac, ready to embed. Only one
+    picture is read at a time in each worker, and processed covers are cached by the
+    hash of the original image so the tracks of an album share one copy.
+    :param pictures: FlacPictures of source, see read_flac_metadata()
+    :param art_size: scale covers larger than this many pixels on their longest side
+    down to fit, as a jpeg. Needs Pillow, covers are left as they are without it.
+    :param art_max_bytes: leave out covers still larger than this
+    :return: (mime, data), or None if there is no usable cover
+    """
+    pictures = [p for p in pictures if p.mime in ART_EXTENSIONS]
+    if not pictures:
+        return None
+    picture = next((p for p in pictures if p.type == FRONT_COVER), pictures[0])
+    with _art_readers, open(source, 'rb') as f:
+        # hashed in blocks first, so covers already in the cache are never held whole
+        digest = hashlib.sha1()
+        f.seek(picture.offset)
+        remaining = picture.length
+        while remaining:
+            block = f.read(min(remaining, 1 << 20))
+            if not block:
+                return None
+            digest.update(block)
+            remaining -= len(block)
+        key = (digest.digest(), art_size, art_max_bytes)
+        with _art_cache_lock:
+            if key in _art_cache:
+                _art_cache.move_to_end(key)
+                return _art_cache[key]
+        f.seek(picture.offset)
+        cover = _process_cover(picture, f.read(picture.length), art_size, art_max_bytes)
+    size = len(cover[1]) if cover is not None else 0
+    if size > ART_CACHE_BYTES:
+        return cover
+    with _art_cache_lock:
+        if key not in _art_cache:
+            _art_cache[key] = cover
+            _art_cache_bytes[0] += size
+        while _art_cache_bytes[0] > ART_CACHE_BYTES:
+            _, evicted = _art_cache.popitem(last=False)
+            _art_cache_bytes[0] -= len(evicted[1]) if evicted is not None else 0
+    return cover
+
+
+def _process_cover(picture, data, art_size=None, art_max_bytes=None):
+    """scales and size checks a cover for read_cover()"""
+    mime = picture.mime
+    # the size in the picture block is often left as 0, so those are opened to check
+    if (art_size and Image is not None
+            and (not picture.width or max(picture.width, picture.height) > art_size)):
+        try:
+            image = Image.open(io.BytesIO(data))
+            if max(image.size) > art_size:
+                image.thumbnail((art_size, art_size))
+                scaled = io.BytesIO()
+                image.convert('RGB').save(scaled, 'JPEG', quality=ART_JPEG_QUALITY)
+                mime, data = 'image/jpeg', scaled.getvalue()
+        except (IOError, OSError, ValueError):
+            pass  # embedded as it is
+    if art_max_bytes and len(data) > art_max_bytes:
+        return None
+    return mime, data
+
+
+def _write_cover(cover):
+    """writes a cover from read_cover() to a temporary file for an encoder to embed.
+    :return: the path of the file, or None if there is no cover"""
+    if cover is None:
+        return None
+    mime, data = cover
+    fd, art_path = tempfile.mkstemp(suffix=ART_EXTENSIONS[mime])
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    return art_path
+
+
+def clone_folder(source, dest, recursive=False, resume=False, link='copy'):
     """Handles The copying of additional non-flac files (ex: cover.jpg etc) from
-    input to output folder."""
-    if recursive:
-        if os.path.exists(dest):
-            raise IOError('destination folder "{}" already exists, cannot copy '
-                          'recursivly'.format(dest))
+    input to output folder. If resume is set, an existing recursive clone is
+    completed instead of raising an error."""
+    to_copy = prepare_clone(source, dest, recursive=recursive, resume=resume)
+    for f, new_file in to_copy:
+        copy_file(f, new_file, link=link)
+    return [f for f, _ in to_copy]
 
-        shutil.copytree(source, dest, ignore=shutil.ignore_patterns('*.flac'))
-        return
-    else:
-        if not os.path.exists(dest):
-            os.mkdir(dest)
-        files = [
-            os.path.join(source, f) for f in os.listdir(source)
-            if os.path.isfile(os.path.join(source, f))
-        ]
-        to_copy = []
+
+def prepare_clone(source, dest, recursive=False, resume=False, index=None):
+    """
+    Creates the folder structure for a clone of source and lists the non-flac files
+    that need copying into it. See clone_folder().
+    :param index: optional DirectoryIndex to list folders with
+    :return: list of (file, new_file) tuples
+    """
+    if recursive and os.path.exists(dest) and not resume:
+        raise IOError('destination folder "{}" already exists, cannot copy '
+                      'recursivly'.format(dest))
+    folders, to_copy = list_clone(source, dest, recursive=recursive, index=index)
+    for folder in folders:
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+    if resume:
+        to_copy = [(f, new_file) for f, new_file in to_copy
+                   if not os.path.exists(new_file)]
+    return to_copy
+
+
+def list_clone(source, dest, recursive=False, index=None):
+    """
+    Lists the folders and non-flac files a clone of source to dest is made of, without
+    creating anything. See prepare_clone().
+    :return: ([new_folder, ...], [(file, new_file), ...])
+    """
+    folders, to_copy = [], []
+    pending = [(source, dest)]
+    while pending:
+        root, new_root = pending.pop()
+        folders.append(new_root)
+        for name, kind in list_folder(root, index):
+            if kind == 'd' and recursive:
+                pending.append((os.path.join(root, name), os.path.join(new_root, name)))
+            elif kind == 'f' and not name.endswith('.flac'):
+                to_copy.append((os.path.join(root, name), os.path.join(new_root, name)))
+    return folders, to_copy
+
+
+def copy_file(source, dest, link='copy'):
+    """
+    copies source to dest along with its permissions and timestamps.
+    :param link: "copy" to copy the data, "reflink" to make a copy-on-write clone or
+    "hardlink" to link dest to source. Reflinks and hardlinks fall back to copying
+    when the filesystem doesn't support them or dest is on another filesystem.
+    """
+    if link == 'hardlink':
+        try:
+            os.link(source, dest)
+            return
+        except OSError:
+            pass
+    with open(source, 'rb') as src, open(dest, 'wb') as dst:
+        if link == 'reflink' and fcntl is not None:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                cloned = True
+            except (IOError, OSError):
+                cloned = False
+        else:
+            cloned = False
+        if not cloned:
+            _copy_data(src, dst)
+    shutil.copystat(source, dest)
+
+
+def _copy_data(src, dst):
+    """copies the contents of one open file to another, in the kernel where possible"""
+    # errors meaning the kernel copy isn't supported here, rather than a failed copy
+    unsupported = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                   errno.ENOTSOCK, errno.EBADF)
+    size = os.fstat(src.fileno()).st_size
+    offset = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < size:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), size - offset,
+                                            offset, offset)
+                if not copied:
+                    return
+                offset += copied
+            return
+        except OSError as e:
+            if offset or e.errno not in unsupported:
+                raise
+    if hasattr(os, 'sendfile'):
+        try:
+            while offset < size:
+                sent = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+                if not sent:
+                    return
+                offset += sent
+            return
+        except OSError as e:
+            if offset or e.errno not in unsupported:
+                raise
+    shutil.copyfileobj(src, dst)
+
+
+def _resume_roots(output, folders_to_clone, source_folders):
+    """folders an interrupted conversion may have left partial mp3s in: the output,
+    the cloned folders, or the source folders themselves for an in-place conversion"""
+    if output:
+        return [output]
+    if folders_to_clone:
+        return [dest for _, dest in folders_to_clone]
+    return source_folders
+
+
+def _noting_folders(targets, folders):
+    """yields targets, adding the folders among them to folders"""
+    for target in targets:
+        if os.path.isdir(target):
+            folders.append(target)
+        yield target
+
+
+def clean_partials(folder):
+    """removes partial mp3s left in folder by an interrupted conversion.
+    :return: the number of files removed"""
+    removed = 0
+    for root, dirs, files in os.walk(folder):
         for f in files:
-            if f.endswith('.flac'):
-                pass
+            if f.endswith(TEMP_SUFFIX):
+                os.remove(os.path.join(root, f))
+                removed += 1
+    return removed
+
+
+class Profile(collections.namedtuple('Profile', 'name encoder args')):
+    """an output format: a name for its output tree, an encoder and its arguments"""
+    __slots__ = ()
+
+    @property
+    def extension(self):
+        return ENCODERS[self.encoder][0]
+
+    @property
+    def settings(self):
+        """identifies the encoder settings in the manifest"""
+        return ' '.join((self.encoder, ) + self.args)
+
+    def command(self, tag_args, dest):
+        return ENCODERS[self.encoder][1] + self.args + tuple(tag_args) + ('-', dest)
+
+
+def parse_profile(spec):
+    """parses a "NAME=ENCODER [ARGS]" profile, ex: "V0=lame -V0" or
+    "OPUS=opusenc --bitrate 160" """
+    name, sep, command = spec.partition('=')
+    command = command.split()
+    if not sep or not name.strip() or not command:
+        raise ValueError('profile must be in the format "NAME=ENCODER [ARGS]": '
+                         '"{}"'.format(spec))
+    if command[0] not in ENCODERS:
+        raise ValueError('unknown encoder "{}", must be one of: {}'.format(
+            command[0], ', '.join(sorted(ENCODERS))))
+    return Profile(name.strip(), command[0], tuple(command[1:]))
+
+
+class StreamInfo(
+        collections.namedtuple('StreamInfo',
+                               'sample_rate channels bits_per_sample total_samples md5')):
+    """the contents of a flac STREAMINFO block"""
+    __slots__ = ()
+
+    @property
+    def duration(self):
+        if not self.sample_rate:
+            return 0.0
+        return self.total_samples / float(self.sample_rate)
+
+
+CueTrack = collections.namedtuple('CueTrack', 'number start tags')
+
+
+def find_cue(source):
+    """
+    finds the cue sheet of a flac image: a .cue file named after it, or one embedded
+    in the flac as a CUESHEET tag or metadata block.
+    :return: list of CueTracks, whose start is in samples, or None if source doesn't
+    have a cue sheet splitting it into several tracks.
+    """
+    info = flac_streaminfo(source)
+    if info is None or not info.sample_rate:
+        return None
+    tracks = None
+    try:
+        for path in (os.path.splitext(source)[0] + '.cue', source + '.cue'):
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    data = f.read()
+                try:
+                    text = data.decode('utf-8-sig')
+                except UnicodeDecodeError:
+                    text = data.decode('latin1')
+                tracks = parse_cue(text, info.sample_rate)
+                break
+        else:
+            # only the tags and CUESHEET block are read, not any pictures
+            flac_meta = read_flac_metadata(source)
+            if flac_meta is None:
+                raise ValueError('bad metadata')
+            if 'cuesheet' in flac_meta.tags:
+                tracks = parse_cue(flac_meta.tags['cuesheet'][0], info.sample_rate)
+            elif flac_meta.cuesheet is not None:
+                # only has track positions, the lead-out is numbered 170 or 255
+                tracks = []
+                for track in flac_meta.cuesheet.tracks:
+                    if track.track_number in (170, 255):
+                        continue
+                    offsets = [index.index_offset for index in track.indexes
+                               if index.index_number == 1]
+                    tracks.append(CueTrack(track.track_number,
+                                           track.start_offset + sum(offsets[:1]),
+                                           {'tracknumber': str(track.track_number)}))
+    except (IOError, OSError, MutagenError, ValueError) as e:
+        warnings.warn('could not read the cue sheet of "{}": {}'.format(source, e))
+        return None
+    if not tracks or len(tracks) < 2:
+        return None
+    return tracks
+
+
+def parse_cue(text, sample_rate):
+    """
+    parses a cue sheet for a single file.
+    :return: list of CueTracks, or None if the cue sheet spans several files.
+    """
+    album = {}
+    tracks = []
+    files = 0
+    for line in text.splitlines():
+        command, _, value = line.strip().partition(' ')
+        command, value = command.upper(), value.strip()
+        if command == 'REM':
+            command, _, value = value.partition(' ')
+            command, value = command.upper(), value.strip()
+        if len(value) > 1 and value[0] == value[-1] == '"':
+            value = value[1:-1]
+        if command == 'FILE':
+            files += 1
+        elif command == 'TRACK':
+            tracks.append({'number': int(value.split()[0]), 'tags': {}})
+        elif command == 'INDEX' and tracks:
+            number, stamp = value.split()
+            if int(number) == 1:
+                minutes, seconds, frames = (int(part) for part in stamp.split(':'))
+                # cd frames, 75 to the second
+                tracks[-1]['start'] = (
+                    ((minutes * 60 + seconds) * 75 + frames) * sample_rate // 75)
+        elif tracks and command in CUE_TRACK_TAGS:
+            tracks[-1]['tags'][CUE_TRACK_TAGS[command]] = value
+        elif not tracks and command in CUE_ALBUM_TAGS:
+            album[CUE_ALBUM_TAGS[command]] = value
+    if files > 1:
+        return None
+    result = []
+    for track in tracks:
+        if 'start' not in track:
+            raise ValueError('track {} has no INDEX 01'.format(track['number']))
+        tags = dict(album)
+        tags.update(track['tags'])
+        tags['tracknumber'] = '{}/{}'.format(track['number'], len(tracks))
+        result.append(CueTrack(track['number'], track['start'], tags))
+    return result
+
+
+def cue_track_path(dest, track):
+    """path of a track split from the image that would have been converted to dest"""
+    title = track.tags.get('title')
+    if not title:
+        title = os.path.splitext(os.path.basename(dest))[0]
+    name = '{:02d} - {}'.format(track.number, re.sub(r'[\\/:*?"<>|]', '_', title))
+    return os.path.join(os.path.dirname(dest), name + os.path.splitext(dest)[1])
+
+
+def flac_streaminfo(path):
+    """reads the STREAMINFO block from the start of a flac file without decoding any
+    audio. Returns None if the file can't be read or isn't a flac.
+    :param path: path or binary file object"""
+    try:
+        f = path if hasattr(path, 'read') else open(path, 'rb')
+    except (IOError, OSError):
+        return None
+    try:
+        if not _seek_flac_start(f):
+            return None
+        header = bytearray(f.read(38))
+    except (IOError, OSError):
+        return None
+    finally:
+        if f is not path:
+            f.close()
+    # STREAMINFO must be the first metadata block and is 34 bytes long
+    if len(header) < 38 or header[0] & 0x7F != 0 or header[1:4] != b'\x00\x00\x22':
+        return None
+    return _parse_streaminfo(bytes(header[4:]))
+
+
+def _seek_flac_start(f):
+    """
+    moves f past the "fLaC" magic bytes, skipping an ID3v2 tag in front of them, which
+    mutagen and the flac binary both accept.
+    :return: False if f isn't a flac
+    """
+    header = bytearray(f.read(10))
+    start = 0
+    if len(header) == 10 and header[:3] == b'ID3':
+        # the tag's size is syncsafe, 7 bits per byte, and doesn't count its header
+        size = 0
+        for byte in header[6:10]:
+            size = (size << 7) | (byte & 0x7F)
+        start = 10 + size
+        if header[5] & 0x10:
+            start += 10  # footer
+    f.seek(start)
+    return f.read(4) == b'fLaC'
+
+
+def _parse_streaminfo(block):
+    """StreamInfo from the 34 bytes of a STREAMINFO block"""
+    # 20 bits sample rate, 3 bits channels - 1, 5 bits bps - 1, 36 bits total samples
+    packed, = struct.unpack('>Q', block[10:18])
+    return StreamInfo(sample_rate=packed >> 44,
+                      channels=((packed >> 41) & 0x7) + 1,
+                      bits_per_sample=((packed >> 36) & 0x1F) + 1,
+                      total_samples=packed & 0xFFFFFFFFF,
+                      md5=block[18:34])
+
+
+def check_flac(source):
+    """
+    checks that source looks like a usable flac without decoding it: the magic bytes,
+    STREAMINFO, the structure of the vorbis comment block, and that an audio frame
+    follows the metadata. Other blocks, like pictures, are skipped rather than read.
+    :param source: path or binary file object
+    :return: (StreamInfo, None), or (None, reason) for a bad file
+    """
+    try:
+        f = source if hasattr(source, 'read') else open(source, 'rb')
+    except (IOError, OSError) as e:
+        return None, 'could not be read: {}'.format(e.strerror or e)
+    try:
+        size = f.seek(0, os.SEEK_END)
+        f.seek(0)
+        if not _seek_flac_start(f):
+            return None, 'is not a flac file'
+        info = None
+        last = False
+        while not last:
+            header = bytearray(f.read(4))
+            if len(header) < 4:
+                return None, 'has truncated metadata'
+            last = bool(header[0] & 0x80)
+            kind = header[0] & 0x7F
+            length = (header[1] << 16) | (header[2] << 8) | header[3]
+            if kind == 127 or f.tell() + length > size:
+                return None, 'has a corrupt metadata block'
+            if info is None:
+                if kind != 0 or length != 34:
+                    return None, 'has no STREAMINFO'
+                info = _parse_streaminfo(f.read(34))
+                if not info.sample_rate or info.bits_per_sample < 4:
+                    return None, 'has an invalid STREAMINFO'
+            elif kind == 4 and not _valid_vorbis_comment(f.read(length)):
+                return None, 'has a corrupt vorbis comment block'
+            elif kind != 4:
+                f.seek(length, os.SEEK_CUR)
+        sync = bytearray(f.read(2))
+        if len(sync) < 2 or sync[0] != 0xFF or sync[1] & 0xFE != 0xF8:
+            return None, 'has no audio after its metadata'
+    except (IOError, OSError) as e:
+        return None, 'could not be read: {}'.format(e.strerror or e)
+    finally:
+        if f is not source:
+            f.close()
+    return info, None
+
+
+def _valid_vorbis_comment(block):
+    """checks the lengths in a vorbis comment block add up"""
+    if len(block) < 8:
+        return False
+    vendor, = struct.unpack_from('<I', block, 0)
+    offset = 4 + vendor
+    if offset + 4 > len(block):
+        return False
+    count, = struct.unpack_from('<I', block, offset)
+    offset += 4
+    for _ in range(count):
+        if offset + 4 > len(block):
+            return False
+        length, = struct.unpack_from('<I', block, offset)
+        offset += 4 + length
+        if offset > len(block) or b'=' not in block[offset - length:offset]:
+            return False
+    return True
+
+
+def check_flacs(target_files, workers=PREFLIGHT_WORKERS):
+    """
+    checks every source in target_files with check_flac(), on several threads
+    :param target_files: iterable of (source, dest) tuples
+    :return: (valid, durations, rejected), where valid is the list of (source, dest)
+    tuples of good flacs, durations maps each good source to its length in seconds and
+    rejected is a list of (source, reason) for the bad ones
+    """
+    target_files = list(target_files)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        checks = pool.map(check_flac, [source for source, _ in target_files])
+        valid, durations, rejected = [], {}, []
+        for (source, dest), (info, error) in zip(target_files, checks):
+            if error is not None:
+                rejected.append((source, error))
+                continue
+            valid.append((source, dest))
+            durations[source] = info.duration
+    return valid, durations, rejected
+
+
+def format_duration(seconds):
+    """seconds as H:MM:SS"""
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+
+def calibrate_encoder(source, commands, seconds=CALIBRATION_SECONDS):
+    """
+    measures how fast this machine encodes, and at what bitrate, by encoding the start
+    of source with each of commands and discarding the output.
+    :param commands: encoder command lines that read a wav from stdin and write the
+    encoded audio to stdout
+    :return: (realtime_factor, bytes_per_second) of one core running every command, or
+    None if source could not be encoded
+    """
+    info = flac_streaminfo(source)
+    if info is None or not info.total_samples:
+        return None
+    samples = min(info.total_samples, int(seconds * info.sample_rate))
+    elapsed, encoded = 0.0, 0
+    for command in commands:
+        start = time.time()
+        try:
+            ps_flac = subprocess.Popen(
+                ('flac', '-d', '-c', '-s', '--until={}'.format(samples), source),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL)
+            encoder = subprocess.Popen(command,
+                                       stdin=ps_flac.stdout,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.DEVNULL)
+        except OSError:
+            return None
+        ps_flac.stdout.close()
+        for block in iter(functools.partial(encoder.stdout.read, 1 << 16), b''):
+            encoded += len(block)
+        if encoder.wait() != 0 or ps_flac.wait() != 0:
+            return None
+        elapsed += time.time() - start
+    length = float(samples) / info.sample_rate
+    return length / max(elapsed, 1e-6), encoded / length
+
+
+def estimate_duration(path):
+    """length of a flac in seconds, from STREAMINFO or guessed from the file size"""
+    info = flac_streaminfo(path)
+    if info is not None and info.total_samples:
+        return info.duration
+    try:
+        return os.path.getsize(path) / float(FLAC_BYTES_PER_SECOND)
+    except OSError:
+        return 0.0
+
+
+class CpuMonitor(object):
+    """measures system wide cpu utilization (0.0 - 1.0) since the previous call"""
+
+    def __init__(self):
+        self._last = self._read_times()
+        self._utilization = 0.0
+
+    @staticmethod
+    def _read_times():
+        try:
+            with open('/proc/stat') as f:
+                times = [int(t) for t in f.readline().split()[1:]]
+        except (IOError, OSError, ValueError):
+            return None
+        idle = sum(times[3:5])  # idle + iowait
+        return sum(times), idle
+
+    def utilization(self):
+        current = self._read_times()
+        if current is None or self._last is None:
+            try:
+                return os.getloadavg()[0] / cpu_count()
+            except (AttributeError, OSError):  # no load average on windows
+                return 0.0
+        total, idle = current[0] - self._last[0], current[1] - self._last[1]
+        if total > 0:
+            self._utilization = 1.0 - idle / float(total)
+            self._last = current
+        return self._utilization
+
+
+def _as_dest(dest):
+    """a dest read back from json, where tuples of dests become lists"""
+    return tuple(dest) if isinstance(dest, list) else dest
+
+
+def _as_tuple(dests):
+    """a job's destination as a tuple, whether it has one or several"""
+    return dests if isinstance(dests, tuple) else (dests, )
+
+
+def _timed(iterable, stats, key):
+    """yields from iterable, adding the time spent waiting on it to stats[key]"""
+    iterator = iter(iterable)
+    while True:
+        start = time.time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            stats[key] += time.time() - start
+        yield item
+
+
+def _children_cpu_time():
+    """total user and system cpu seconds used by reaped child processes"""
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def percentile(ordered, fraction):
+    """nearest rank percentile of an already sorted sequence"""
+    if not ordered:
+        return None
+    rank = int(math.ceil(fraction * len(ordered))) - 1
+    return ordered[min(max(rank, 0), len(ordered) - 1)]
+
+
+def summarize_timings(samples):
+    """summarizes lists of timings into count, total and p50/p90/p99/max for each"""
+    summary = {}
+    for key, values in samples.items():
+        ordered = sorted(values)
+        summary[key] = {
+            'count': len(ordered),
+            'total': sum(ordered),
+            'p50': percentile(ordered, 0.5),
+            'p90': percentile(ordered, 0.9),
+            'p99': percentile(ordered, 0.99),
+            'max': ordered[-1] if ordered else None,
+        }
+    return summary
+
+
+def print_summary(summary):
+    print('{:<12}{:>8}{:>12}{:>10}{:>10}{:>10}{:>10}'.format('seconds', 'count', 'total',
+                                                              'p50', 'p90', 'p99', 'max'))
+    for key in sorted(summary):
+        row = summary[key]
+        print('{:<12}{:>8}{:>12.2f}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}'.format(
+            key, row['count'], row['total'], row['p50'], row['p90'], row['p99'],
+            row['max']))
+
+
+class MetricsStream(object):
+    """writes metric events as json lines to a file, or a "tcp://HOST:PORT" or
+    "unix:PATH" socket"""
+
+    def __init__(self, target):
+        self.target = target
+        self._lock = threading.Lock()
+        self._socket = None
+        if target.startswith('tcp://'):
+            host, _, port = target[len('tcp://'):].rpartition(':')
+            self._socket = socket.create_connection((host, int(port)))
+        elif target.startswith('unix:'):
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(target[len('unix:'):])
+        if self._socket is not None:
+            self._file = self._socket.makefile('w')
+        else:
+            self._file = io.open(target, 'a', encoding='utf8')
+
+    def emit(self, event, **fields):
+        fields['event'] = event
+        fields['time'] = time.time()
+        line = json.dumps(fields, sort_keys=True)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+            if self._socket is not None:
+                self._socket.close()
+
+
+def dedup_key(path):
+    """key identifying the decoded audio of a flac, taken from its STREAMINFO. None if
+    the flac has no audio md5 to go by."""
+    info = flac_streaminfo(path)
+    if info is None or info.md5 == b'\x00' * 16:
+        return None
+    return info
+
+
+def same_tags(flac_a, flac_b):
+    """checks if two flac files have identical tags and pictures"""
+    try:
+        a, b = FLAC(flac_a), FLAC(flac_b)
+    except MutagenError:
+        return False
+    tags_a = sorted(a.tags) if a.tags is not None else []
+    tags_b = sorted(b.tags) if b.tags is not None else []
+    if tags_a != tags_b:
+        return False
+    return [p.write() for p in a.pictures] == [p.write() for p in b.pictures]
+
+
+def file_hash(path, block_size=1 << 20, data=None):
+    """returns the sha1 hex digest of a file's contents
+    :param data: contents of path if they have already been read, see ReadAhead"""
+    digest = hashlib.sha1()
+    if data is not None:
+        digest.update(data)
+        return digest.hexdigest()
+    with open(path, 'rb') as f:
+        for block in iter(functools.partial(f.read, block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Manifest(object):
+    """
+    sqlite record of completed conversions, keyed on destination.
+
+    Each entry stores the size, mtime and content hash of the source and the lame
+    settings used, so that later runs can skip anything that hasn't changed. The
+    hash is only recomputed when the size or mtime of a source differs from the
+    record.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS conversions ('
+                             'dest TEXT PRIMARY KEY, source TEXT, size INTEGER, '
+                             'mtime REAL, hash TEXT, settings TEXT)')
+
+    def is_current(self, source, dest, settings):
+        """checks if dest was produced from the current contents of source using
+        settings"""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT source, size, mtime, hash, settings FROM conversions '
+                'WHERE dest = ?', (dest, )).fetchone()
+        if row is None or not os.path.exists(dest):
+            return False
+        old_source, size, mtime, digest, old_settings = row
+        if old_source != source or old_settings != settings:
+            return False
+        try:
+            st = os.stat(source)
+        except OSError:
+            return False
+        if st.st_size == size and st.st_mtime == mtime:
+            return True
+        if st.st_size != size or file_hash(source) != digest:
+            return False
+        # touched but unchanged, remember the new mtime to avoid rehashing
+        with self._lock, self._db:
+            self._db.execute('UPDATE conversions SET mtime = ? WHERE dest = ?',
+                             (st.st_mtime, dest))
+        return True
+
+    def record(self, source, dest, settings, fingerprint=None):
+        """record a successful conversion of source to dest.
+        :param fingerprint: the (size, mtime, hash) of source if already known
+        """
+        if fingerprint is None:
+            st = os.stat(source)
+            fingerprint = (st.st_size, st.st_mtime, file_hash(source))
+        size, mtime, digest = fingerprint
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO conversions VALUES (?, ?, ?, ?, ?, ?)',
+                (dest, source, size, mtime, digest, settings))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+BrokerJob = collections.namedtuple('BrokerJob', 'id source dest settings')
+
+
+class JobBroker(object):
+    """
+    sqlite queue of conversion jobs shared between a coordinator and workers.
+
+    The coordinator publishes (source, dest, settings) jobs and workers lease them one
+    at a time. A lease has to be renewed before it expires or the job is handed to
+    another worker. Failed and expired jobs are retried until they have been leased
+    retries + 1 times. Everything goes through the database file, so it only needs to
+    be on storage that every host can reach, with sources and outputs at the same
+    paths on each.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # transactions are started explicitly, leasing needs BEGIN IMMEDIATE
+        self._db = sqlite3.connect(path, timeout=60, isolation_level=None,
+                                   check_same_thread=False)
+        with self._lock:
+            self._db.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                             'id INTEGER PRIMARY KEY, source TEXT, dest TEXT, '
+                             'settings TEXT, state TEXT, worker TEXT, expires REAL, '
+                             'attempts INTEGER, started REAL, finished REAL, '
+                             'bytes_in INTEGER, bytes_out INTEGER, error TEXT)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS meta ('
+                             'key TEXT PRIMARY KEY, value TEXT)')
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def _meta(self, key, default=None):
+        with self._lock:
+            row = self._db.execute('SELECT value FROM meta WHERE key = ?',
+                                   (key, )).fetchone()
+        return default if row is None else row[0]
+
+    def reset(self, retries=2):
+        """removes all jobs, ready for a new run"""
+        with self._transaction() as db:
+            db.execute('DELETE FROM jobs')
+            db.execute('DELETE FROM meta')
+            db.execute('INSERT INTO meta VALUES (?, ?)', ('retries', str(retries)))
+
+    def publish(self, jobs, settings):
+        """
+        queues jobs for the workers
+        :param jobs: iterable of (source, dest) tuples
+        :param settings: dict of keyword arguments for _convert_job()
+        :return: number of jobs published
+        """
+        settings = json.dumps(settings)
+        rows = [(source, dest, settings, 'queued', 0) for source, dest in jobs]
+        with self._transaction() as db:
+            db.executemany('INSERT INTO jobs (source, dest, settings, state, attempts) '
+                           'VALUES (?, ?, ?, ?, ?)', rows)
+        return len(rows)
+
+    def close_publishing(self):
+        """tells workers that no more jobs are coming, so they can exit once the queue
+        is empty"""
+        with self._transaction() as db:
+            db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('published', '1'))
+
+    def lease(self, worker, duration):
+        """
+        takes the next queued job, or one whose lease has expired.
+        :param worker: name of the worker taking the job
+        :param duration: seconds until the lease expires unless renewed
+        :return: a BrokerJob or None if there is nothing to do
+        """
+        retries = int(self._meta('retries', 2))
+        now = time.time()
+        with self._transaction() as db:
+            db.execute("UPDATE jobs SET state = 'failed', error = 'lease expired' "
+                       "WHERE state = 'leased' AND expires < ? AND attempts > ?",
+                       (now, retries))
+            row = db.execute("SELECT id, source, dest, settings FROM jobs "
+                             "WHERE state = 'queued' OR (state = 'leased' AND "
+                             "expires < ?) ORDER BY id LIMIT 1", (now, )).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE jobs SET state = 'leased', worker = ?, expires = ?, "
+                       "attempts = attempts + 1, started = ? WHERE id = ?",
+                       (worker, now + duration, now, row[0]))
+        job_id, source, dest, settings = row
+        return BrokerJob(job_id, source, dest, json.loads(settings))
+
+    def renew(self, job_ids, worker, duration):
+        """extends the leases worker holds on job_ids"""
+        with self._transaction() as db:
+            db.executemany("UPDATE jobs SET expires = ? WHERE id = ? AND worker = ? "
+                           "AND state = 'leased'",
+                           [(time.time() + duration, job_id, worker)
+                            for job_id in job_ids])
+
+    def complete(self, job_id, worker, result):
+        """
+        records the JobResult of a leased job. Failed jobs are queued again until they
+        run out of retries. Results for jobs that have since been leased to another
+        worker are ignored.
+        """
+        retries = int(self._meta('retries', 2))
+        error = None
+        if not result.ok:
+            error = '\n'.join(result.messages) or 'conversion failed'
+
+        with self._transaction() as db:
+            row = db.execute("SELECT attempts FROM jobs WHERE id = ? AND worker = ? "
+                             "AND state = 'leased'", (job_id, worker)).fetchone()
+            if row is None:
+                return
+            if result.ok:
+                state = 'done'
+            else:
+                state = 'queued' if row[0] <= retries else 'failed'
+            db.execute('UPDATE jobs SET state = ?, finished = ?, bytes_in = ?, '
+                       'bytes_out = ?, error = ? WHERE id = ?',
+                       (state, time.time(), result.bytes_in, result.bytes_out, error,
+                        job_id))
+
+    def counts(self):
+        """number of jobs in each state"""
+        with self._lock:
+            rows = self._db.execute('SELECT state, COUNT(*) FROM jobs '
+                                    'GROUP BY state').fetchall()
+        counts = {'queued': 0, 'leased': 0, 'done': 0, 'failed': 0}
+        counts.update(rows)
+        return counts
+
+    def finished(self):
+        """checks if all jobs have been published and none are left to do"""
+        counts = self.counts()
+        return (self._meta('published') is not None and not counts['queued'] and
+                not counts['leased'])
+
+    def failures(self):
+        """list of (source, error) for jobs that ran out of retries"""
+        with self._lock:
+            return self._db.execute("SELECT source, error FROM jobs "
+                                    "WHERE state = 'failed' ORDER BY id").fetchall()
+
+    def throughput(self):
+        """
+        per worker totals of completed jobs
+        :return: dict of worker -> dict of files, bytes_in, bytes_out and seconds
+        between the worker's first lease and its last completion
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT worker, COUNT(*), SUM(bytes_in), SUM(bytes_out), "
+                "MIN(started), MAX(finished) FROM jobs WHERE state = 'done' "
+                "GROUP BY worker").fetchall()
+        return {
+            worker: {
+                'files': files,
+                'bytes_in': bytes_in or 0,
+                'bytes_out': bytes_out or 0,
+                'seconds': finished - started,
+            }
+            for worker, files, bytes_in, bytes_out, started, finished in rows
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def generate_corpus(path,
+                    files=20,
+                    length=30,
+                    tags=10,
+                    signal='noise',
+                    album_size=10,
+                    sample_rate=44100,
+                    seed=0):
+    """
+    Generates a reproducible corpus of stereo flac files for benchmarking, using the
+    flac binary. Files are grouped into album folders with a cover.jpg in each. An
+    existing corpus generated with the same options is reused.
+    :param path: folder to generate the corpus in
+    :param files: number of flac files to generate
+    :param length: length of each file in seconds
+    :param tags: number of extra tags to add to each file
+    :param signal: "sine" or "noise"
+    :return: path
+    """
+    if signal not in ('sine', 'noise'):
+        raise ValueError('signal must be either "sine" or "noise"')
+    spec = {
+        'files': files,
+        'length': length,
+        'tags': tags,
+        'signal': signal,
+        'album_size': album_size,
+        'sample_rate': sample_rate,
+        'seed': seed,
+    }
+    spec_path = os.path.join(path, 'corpus.json')
+    if os.path.exists(path):
+        try:
+            with open(spec_path) as f:
+                if json.load(f) == spec:
+                    return path
+        except (IOError, OSError, ValueError):
+            raise IOError(
+                '"{}" already exists and is not a benchmark corpus'.format(path))
+        shutil.rmtree(path)
+
+    rng = random.Random(seed)
+    tempdir = tempfile.mkdtemp()
+    try:
+        wav_path = os.path.join(tempdir, 'corpus.wav')
+        for i in range(files):
+            album_number, track_number = divmod(i, album_size)
+            album = os.path.join(path, 'Album {:03d}'.format(album_number + 1))
+            if track_number == 0:
+                os.makedirs(album)
+                with open(os.path.join(album, 'cover.jpg'), 'wb') as f:
+                    f.write(bytearray(rng.getrandbits(8) for _ in range(1 << 16)))
+
+            # one second of audio, repeated for the length of the track
+            if signal == 'sine':
+                step = 2 * 3.141592653589793 * 110 * (1 + i % 8) / sample_rate
+                second = array.array(
+                    'h', (int(12000 * math.sin(n * step)) for n in range(sample_rate)
+                          for _ in range(2)))
             else:
-                to_copy.append(f)
+                second = array.array(
+                    'h', (rng.randint(-12000, 12000) for _ in range(sample_rate * 2)))
+            if sys.byteorder == 'big':
+                second.byteswap()
+            wav = wave.open(wav_path, 'wb')
+            try:
+                wav.setnchannels(2)
+                wav.setsampwidth(2)
+                wav.setframerate(sample_rate)
+                wav.writeframes(second.tobytes() * int(length))
+            finally:
+                wav.close()
+
+            tag_args = [
+                'TITLE=Track {}'.format(track_number + 1),
+                'ARTIST=Artist {}'.format(album_number % 7 + 1),
+                'ALBUM=Album {}'.format(album_number + 1),
+                'TRACKNUMBER={}'.format(track_number + 1),
+            ]
+            tag_args += [
+                'COMMENT{}={:x}'.format(n, rng.getrandbits(128)) for n in range(tags)
+            ]
+            flac = os.path.join(album, '{:02d} Track.flac'.format(track_number + 1))
+            args = ['flac', '-s', '-f', '-o', flac]
+            for tag in tag_args:
+                args += ['-T', tag]
+            subprocess.check_call(args + [wav_path],
+                                  stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL)
+    finally:
+        shutil.rmtree(tempdir)
+
+    with open(spec_path, 'w') as f:
+        json.dump(spec, f)
+    return path
+
+
+def _peak_rss():
+    """peak resident set size in KB of this process or any of its children"""
+    if resource is None:
+        return None
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak // 1024 if sys.platform == 'darwin' else peak
 
-        for f in to_copy:
-            shutil.copy(f, dest)
-        return to_copy
+
+def _bench_worker(corpus, num_cores, lame_args, connection):
+    """converts the corpus once in a fresh process, sending the stats back"""
+    tempdir = tempfile.mkdtemp()
+    stats = {}
+    try:
+        start = time.time()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            convert([corpus],
+                    output=os.path.join(tempdir, 'output'),
+                    clone=True,
+                    recursive=True,
+                    lame_args=lame_args,
+                    num_cores=num_cores,
+                    stats=stats)
+        stats['wall'] = time.time() - start
+    finally:
+        shutil.rmtree(tempdir)
+    stats['peak_rss_kb'] = _peak_rss()
+    connection.send(stats)
+    connection.close()
+
+
+def bench(corpus,
+          cores=(1, 2),
+          settings=('-V0', ),
+          files=20,
+          length=30,
+          tags=10,
+          signal='noise',
+          json_path=None):
+    """
+    Benchmark convert() over a synthetic corpus with every combination of core count
+    and lame settings. Each run happens in a fresh process so that peak memory is
+    measured per run. Prints a table of the results followed by the results as json.
+    :param corpus: folder for the synthetic corpus, see generate_corpus()
+    :param cores: core counts to benchmark
+    :param settings: lame argument strings to benchmark
+    :param json_path: write the json results here instead of printing them
+    :return: list of result dicts
+    """
+    print('Generating corpus...')
+    generate_corpus(corpus, files=files, length=length, tags=tags, signal=signal)
+    audio_seconds = files * length
+
+    results = []
+    for lame_args in settings:
+        for num_cores in cores:
+            print('Benchmarking "{}" on {} cores...'.format(lame_args, num_cores))
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            ps = multiprocessing.Process(target=_bench_worker,
+                                         args=(corpus, num_cores, lame_args, sender))
+            ps.start()
+            stats = receiver.recv()
+            ps.join()
+            stats.update({
+                'settings': lame_args,
+                'cores': num_cores,
+                'files_per_second': stats['files'] / stats['wall'],
+                'realtime_factor': audio_seconds / stats['wall'],
+            })
+            results.append(stats)
+
+    columns = (('settings', 'settings', 12, ''), ('cores', 'cores', 5, ''),
+               ('files', 'files', 6, ''), ('wall s', 'wall', 8, '.2f'),
+               ('files/s', 'files_per_second', 8, '.2f'),
+               ('audio s/s', 'realtime_factor', 9, '.1f'),
+               ('discover', 'discovery', 9, '.3f'), ('clone s', 'cloning', 8, '.3f'),
+               ('encode s', 'encoding', 9, '.2f'), ('tag s', 'tagging', 8, '.2f'),
+               ('peak RSS KB', 'peak_rss_kb', 11, ''))
+    print()
+    print(' '.join('{:>{}}'.format(header, width) for header, _, width, _ in columns))
+    for stats in results:
+        print(' '.join('{:>{}{}}'.format(stats[key], width, spec)
+                       for _, key, width, spec in columns))
+    print()
+
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    return results
+
+
+def bench_paths(count, folder_size=12, sub=('^(\\d+) ', '\\1 - '), json_path=None):
+    """
+    Benchmark mapping count generated flac paths, in folders of folder_size files, to
+    output paths: with the str.replace of the base folder that get_output_path() used
+    to do, with get_output_path(), which maps every folder again, and with one shared
+    PathMapper. All must give the same paths.
+    :param sub: (pattern, repl) replacement applied to the file names
+    :param json_path: write the json results here instead of printing them
+    :return: list of result dicts
+    """
+    source, output = os.path.join(os.sep, 'music'), os.path.join(os.sep, 'mp3')
+    paths = [
+        os.path.join(source, 'Artist {}'.format(n // (folder_size * 8)),
+                     'Album {}'.format(n // folder_size),
+                     '{:02d} Track.flac'.format(n % folder_size + 1))
+        for n in range(count)
+    ]
+    sub = (re.compile(sub[0]), sub[1])
+
+    def replace_base(p):
+        f_name, _, _ = p.rpartition('.flac')
+        f_name = f_name.replace(source, output)
+        f_name = os.path.join(os.path.dirname(f_name),
+                              re.sub(sub[0], sub[1], os.path.basename(f_name)))
+        return f_name + '.mp3'
+
+    results = []
+    mapped = []
+    mapper = PathMapper(sub)
+    for name, map_path in (
+            ('str.replace', replace_base),
+            ('get_output_path', lambda p: get_output_path(output, p, source, sub)),
+            ('PathMapper', lambda p: mapper.map(output, p, source))):
+        start = time.time()
+        mapped.append([map_path(p) for p in paths])
+        wall = time.time() - start
+        results.append({
+            'method': name,
+            'paths': count,
+            'wall': wall,
+            'paths_per_second': count / wall,
+        })
+    if any(paths != mapped[0] for paths in mapped[1:]):
+        raise AssertionError('the path mappings disagree')
+
+    print()
+    print('{:>16} {:>10} {:>8} {:>12}'.format('method', 'paths', 'wall s', 'paths/s'))
+    for result in results:
+        print('{method:>16} {paths:>10} {wall:>8.3f} {paths_per_second:>12.0f}'.format(
+            **result))
+    print()
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    return results
 
 
 def main():
@@ -510,9 +4354,34 @@ def main():
         print('Could not find lame.exe! please ensure it is installed and in your path.')
         exit(1)
 
+    if arguments['bench'] and arguments['--bench-paths']:
+        bench_paths(int(arguments['--bench-paths']), json_path=arguments['--bench-json'])
+        return
+
+    if arguments['bench']:
+        bench(arguments['--corpus'],
+              cores=[int(n) for n in arguments['--bench-cores'].split(',')],
+              settings=arguments['--bench-settings'].split(','),
+              files=int(arguments['--corpus-files']),
+              length=int(arguments['--corpus-length']),
+              tags=int(arguments['--corpus-tags']),
+              signal=arguments['--corpus-signal'],
+              json_path=arguments['--bench-json'])
+        return
+
     if arguments['--num-cores'] is not None:
         if arguments['--num-cores'].lower() == 'max':
             arguments['--num-cores'] = cpu_count()
+        elif arguments['--num-cores'].lower() == 'auto':
+            arguments['--num-cores'] = 'auto'
+
+    if arguments['worker']:
+        work(arguments['--broker'],
+             name=arguments['--worker-name'],
+             num_cores=arguments['--num-cores'],
+             lease=float(arguments['--lease']),
+             verbose=True)
+        return
 
     if arguments['--VBR'] is None:
         arguments['--VBR'] = 0
@@ -522,20 +4391,85 @@ def main():
         t = sys.stdin.read().strip().split("\n")
         arguments['<SOURCES>'] = t
 
-    convert(arguments['<SOURCES>'],
-            output=arguments['--output'],
-            clone=arguments['--clone'],
-            recursive=arguments['--recursive'],
-            folder_suffix=arguments['--folder-suffix'],
-            vbr_level=arguments['--VBR'],
-            cbr=arguments['--bitrate'],
-            lame_args=arguments['--lame-args'],
-            overwrite=arguments['--overwrite'],
-            delete_flacs=arguments['--delete-flacs'],
-            num_cores=arguments['--num-cores'],
-            nice_val=int(arguments['--nice']),
-            replacement=arguments['--replace'],
-            verbose=True)
+    options = dict(output=arguments['--output'],
+                   clone=arguments['--clone'],
+                   recursive=arguments['--recursive'],
+                   folder_suffix=arguments['--folder-suffix'],
+                   vbr_level=arguments['--VBR'],
+                   cbr=arguments['--bitrate'],
+                   lame_args=arguments['--lame-args'],
+                   overwrite=arguments['--overwrite'],
+                   delete_flacs=arguments['--delete-flacs'],
+                   num_cores=arguments['--num-cores'],
+                   nice_val=int(arguments['--nice']),
+                   replacement=arguments['--replace'],
+                   manifest=arguments['--manifest'],
+                   decoder=arguments['--decoder'],
+                   order=arguments['--order'],
+                   metrics=arguments['--metrics'],
+                   tagger=arguments['--tagger'],
+                   resume=arguments['--resume'],
+                   dedup=arguments['--dedup'],
+                   link=arguments['--link'],
+                   io_workers=arguments['--io-workers'],
+                   profiles=arguments['--profile'],
+                   index=arguments['--index'],
+                   split=arguments['--split'],
+                   cue=arguments['--cue'],
+                   read_ahead=arguments['--read-ahead'],
+                   max_readers=int(arguments['--max-readers']),
+                   max_writers=arguments['--max-writers'],
+                   preflight=arguments['--preflight'],
+                   art_size=arguments['--art-size'],
+                   art_max_kb=arguments['--art-max-kb'],
+                   verbose=True)
+
+    if arguments['--plan']:
+        plan = plan_conversion(arguments['<SOURCES>'],
+                               output=arguments['--output'],
+                               clone=arguments['--clone'],
+                               recursive=arguments['--recursive'],
+                               folder_suffix=arguments['--folder-suffix'],
+                               vbr_level=arguments['--VBR'],
+                               cbr=arguments['--bitrate'],
+                               lame_args=arguments['--lame-args'],
+                               num_cores=arguments['--num-cores'],
+                               replacement=arguments['--replace'],
+                               profiles=arguments['--profile'])
+        with open(arguments['--plan'], 'w') as f:
+            json.dump(plan, f, indent=2)
+        print_plan(plan)
+    elif arguments['--from-plan']:
+        convert([], plan=arguments['--from-plan'], **options)
+    elif arguments['coordinator']:
+        coordinate(arguments['<SOURCES>'],
+                   arguments['--broker'],
+                   output=arguments['--output'],
+                   clone=arguments['--clone'],
+                   recursive=arguments['--recursive'],
+                   folder_suffix=arguments['--folder-suffix'],
+                   vbr_level=arguments['--VBR'],
+                   cbr=arguments['--bitrate'],
+                   lame_args=arguments['--lame-args'],
+                   overwrite=arguments['--overwrite'],
+                   nice_val=int(arguments['--nice']),
+                   replacement=arguments['--replace'],
+                   decoder=arguments['--decoder'],
+                   tagger=arguments['--tagger'],
+                   resume=arguments['--resume'],
+                   link=arguments['--link'],
+                   retries=int(arguments['--retries']),
+                   art_size=arguments['--art-size'],
+                   art_max_kb=arguments['--art-max-kb'],
+                   verbose=True)
+    elif arguments['watch']:
+        watch(arguments['<SOURCES>'],
+              settle=float(arguments['--settle']),
+              interval=float(arguments['--poll-interval']),
+              polling=arguments['--poll'],
+              **options)
+    else:
+        convert(arguments['<SOURCES>'], **options)
 
     return
 
@@ -1,11 +1,7 @@
-import sys
 from setuptools import setup
 
 requirements = ['mutagen >= 1.0', 'docopt >= 0.6']
 
-if sys.version_info.major == 2:
-    requirements.append('futures >= 2.2')
-
 setup(
     name='convertFlac',
     version='1.11',
@@ -20,7 +16,9 @@ setup(
     'A script that uses subprocess to call flac and lame to convert flac files to mp3 '
     'and transfer tags asynchronously',
     py_modules=['convertFlac'],
+    python_requires='>=3.7',
     install_requires=requirements,
+    extras_require={'soundfile': ['soundfile >= 0.10'], 'art': ['Pillow >= 6.0']},
     entry_points={
         'console_scripts': [
             'convertFlac = convertFlac:main'
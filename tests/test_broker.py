@@ -0,0 +1,73 @@
+"""
+tests for the lease, expiry and retry handling of convertFlac.JobBroker
+"""
+import pytest
+
+import convertFlac
+
+# a lease that has already run out by the time anyone looks at it
+EXPIRED = -1
+
+
+@pytest.fixture
+def broker(tmp_path):
+    broker = convertFlac.JobBroker(str(tmp_path / 'jobs.db'))
+    broker.reset(retries=2)
+    broker.publish([('a.flac', 'a.mp3')], {'vbr': 0})
+    broker.close_publishing()
+    return broker
+
+
+def failed(job):
+    return convertFlac.JobResult(job.source, job.dest, messages=['lame failed'])
+
+
+def test_lease(broker):
+    job = broker.lease('w1', 60)
+    assert (job.source, job.dest, job.settings) == ('a.flac', 'a.mp3', {'vbr': 0})
+    # a live lease isn't handed to anyone else
+    assert broker.lease('w2', 60) is None
+    assert broker.counts()['leased'] == 1
+    assert not broker.finished()
+
+    broker.complete(job.id, 'w1', convertFlac.JobResult(job.source, job.dest, ok=True))
+    assert broker.counts()['done'] == 1
+    assert broker.finished()
+
+
+def test_expired_lease_is_leased_again(broker):
+    job = broker.lease('w1', EXPIRED)
+    again = broker.lease('w2', 60)
+    assert again is not None and again.id == job.id
+
+    # the first worker's result comes too late and is ignored
+    broker.complete(job.id, 'w1', failed(job))
+    assert broker.counts()['leased'] == 1
+    broker.complete(again.id, 'w2', convertFlac.JobResult(job.source, job.dest, ok=True))
+    assert broker.throughput().keys() == {'w2'}
+
+
+def test_renewed_lease_is_kept(broker):
+    job = broker.lease('w1', EXPIRED)
+    broker.renew([job.id], 'w1', 60)
+    assert broker.lease('w2', 60) is None
+
+
+def test_failures_are_retried(broker):
+    # leased retries + 1 times in all
+    for attempt in range(3):
+        job = broker.lease('w1', 60)
+        assert job is not None, attempt
+        broker.complete(job.id, 'w1', failed(job))
+    assert broker.lease('w1', 60) is None
+    assert broker.counts()['failed'] == 1
+    assert broker.failures() == [('a.flac', 'lame failed')]
+    assert broker.finished()
+
+
+def test_expired_leases_run_out_of_retries(broker):
+    for attempt in range(3):
+        assert broker.lease('w1', EXPIRED) is not None, attempt
+    assert broker.lease('w1', 60) is None
+    assert broker.failures() == [('a.flac', 'lease expired')]
+    assert broker.finished()
@@ -0,0 +1,72 @@
+"""
+tests for telling current conversions from stale ones with convertFlac.Manifest
+"""
+import os
+
+import pytest
+
+import convertFlac
+
+SETTINGS = '-V 0'
+
+
+@pytest.fixture
+def files(tmp_path):
+    source, dest = tmp_path / 'a.flac', tmp_path / 'a.mp3'
+    source.write_bytes(b'fLaC' + bytes(100))
+    dest.write_bytes(b'mp3')
+    return str(source), str(dest)
+
+
+@pytest.fixture
+def manifest(tmp_path, files):
+    manifest = convertFlac.Manifest(str(tmp_path / 'manifest.db'))
+    manifest.record(files[0], files[1], SETTINGS)
+    yield manifest
+    manifest.close()
+
+
+def touch(path, offset=10):
+    st = os.stat(path)
+    os.utime(path, (st.st_atime, st.st_mtime + offset))
+
+
+def test_current(manifest, files):
+    assert manifest.is_current(files[0], files[1], SETTINGS)
+
+
+def test_unrecorded_or_missing(manifest, files, tmp_path):
+    assert not manifest.is_current(files[0], str(tmp_path / 'b.mp3'), SETTINGS)
+    os.remove(files[1])
+    assert not manifest.is_current(files[0], files[1], SETTINGS)
+
+
+def test_changed_settings(manifest, files):
+    assert not manifest.is_current(files[0], files[1], '-V 2')
+
+
+def test_changed_size(manifest, files):
+    with open(files[0], 'ab') as f:
+        f.write(b'more')
+    assert not manifest.is_current(files[0], files[1], SETTINGS)
+
+
+def test_changed_hash(manifest, files):
+    # same size, new contents and mtime
+    with open(files[0], 'r+b') as f:
+        f.seek(10)
+        f.write(b'\xff')
+    touch(files[0])
+    assert not manifest.is_current(files[0], files[1], SETTINGS)
+
+
+def test_touched_but_unchanged(manifest, files, monkeypatch):
+    touch(files[0])
+    assert manifest.is_current(files[0], files[1], SETTINGS)
+
+    # the new mtime is remembered, so the source isn't hashed again
+    def file_hash(path):
+        raise AssertionError('rehashed "{}"'.format(path))
+
+    monkeypatch.setattr(convertFlac, 'file_hash', file_hash)
+    assert manifest.is_current(files[0], files[1], SETTINGS)
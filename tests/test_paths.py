@@ -0,0 +1,53 @@
+"""
+tests for mapping flac paths to output paths, see convertFlac.PathMapper and
+convertFlac.get_output_path(). Both are checked against the same expectations.
+"""
+import os
+
+import pytest
+
+import convertFlac
+
+
+def p(*parts):
+    """an absolute path from its parts"""
+    return os.path.join(os.sep, *parts)
+
+
+def outputs(output, file_path, preserve_from=None, sub=None):
+    mapped = convertFlac.PathMapper(sub).map(output, file_path, preserve_from)
+    assert convertFlac.get_output_path(output, file_path, preserve_from, sub) == mapped
+    return mapped
+
+
+def test_repeated_root():
+    # the source root appears again below itself, only the leading one is replaced
+    assert outputs(p('o'), p('m', 'a', 'm', 'a', 'b.flac'), p('m', 'a')) == p(
+        'o', 'm', 'a', 'b.mp3')
+
+
+@pytest.mark.parametrize('preserve_from', [p('m', 'a'), p('m', 'a') + os.sep])
+def test_trailing_slash(preserve_from):
+    assert outputs(p('o'), p('m', 'a', 'b.flac'), preserve_from) == p('o', 'b.mp3')
+    assert outputs(p('o'), p('m', 'a', 'x', 'b.flac'), preserve_from) == p(
+        'o', 'x', 'b.mp3')
+    assert outputs(p('o') + os.sep, p('m', 'a', 'x', 'b.flac'), preserve_from) == p(
+        'o', 'x', 'b.mp3')
+
+
+def test_explicit_file():
+    assert outputs(p('o'), p('m', 'a', 'b.flac')) == p('o', 'b.mp3')
+    assert outputs(p('o'), 'b.flac') == p('o', 'b.mp3')
+    # no output puts the mp3 next to the flac
+    assert outputs(None, p('m', 'a', 'b.flac')) == p('m', 'a', 'b.mp3')
+
+
+def test_sub_only_renames_the_file():
+    assert outputs(p('o'), p('m', 'b', 'b.flac'), p('m'), sub=('b', 'c')) == p(
+        'o', 'b', 'c.mp3')
+
+
+def test_outside_preserve_from():
+    # a folder sharing a prefix with preserve_from is not inside it
+    with pytest.raises(ValueError):
+        outputs(p('o'), p('m', 'ab', 'b.flac'), p('m', 'a'))
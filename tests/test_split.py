@@ -0,0 +1,118 @@
+"""
+tests for rewriting the LAME info frame of a flac encoded in chunks, see
+convertFlac._split_convert(). The frames are built by hand, laid out as lame writes
+them: an Info frame followed by plain mpeg-1 layer III frames.
+"""
+import struct
+
+import convertFlac
+
+FRAME_SAMPLES = 1152
+FRAME_LENGTH = 417  # 128kbps at 44.1kHz without padding
+XING = 36  # mpeg-1 stereo: 4 byte header and 32 bytes of side info
+LAME = XING + 120
+
+
+def header(bitrate_index=9, rate_index=0, padding=0, mono=False, version=3):
+    """4 byte mpeg audio layer III header, mpeg-1 128kbps 44.1kHz stereo by default"""
+    return bytes((0xFF, 0xE0 | version << 3 | 1 << 1 | 1,
+                  bitrate_index << 4 | rate_index << 2 | padding << 1,
+                  (3 if mono else 0) << 6))
+
+
+def audio_frame(fill=0, **kwargs):
+    head = header(**kwargs)
+    return head + bytes((fill, )) * (FRAME_LENGTH - len(head))
+
+
+def info_frame(delay=576, padding=1000):
+    """an Info frame with a LAME tag, as written for the first chunk"""
+    frame = bytearray(audio_frame())
+    frame[XING:XING + 4] = b'Info'
+    struct.pack_into('>III', frame, XING + 4, 0xF, 5, 5 * FRAME_LENGTH)
+    frame[XING + 16:XING + 116] = bytes(range(100))
+    frame[LAME:LAME + 9] = b'LAME3.100'
+    frame[LAME + 11:LAME + 19] = b'\x01' * 8  # replaygain of the first chunk
+    frame[LAME + 21:LAME + 24] = struct.pack('>I', (delay << 12) | padding)[1:]
+    return bytes(frame)
+
+
+def test_mp3_frames():
+    data = info_frame() + audio_frame(1) + audio_frame(2, padding=1)
+    assert list(convertFlac._mp3_frames(data)) == [
+        (0, FRAME_LENGTH, 44100),
+        (FRAME_LENGTH, FRAME_LENGTH, 44100),
+        (2 * FRAME_LENGTH, FRAME_LENGTH + 1, 44100),
+    ]
+
+
+def test_mp3_frames_stops_at_junk():
+    data = audio_frame() + b'TAG' + bytes(125) + audio_frame()
+    assert list(convertFlac._mp3_frames(data)) == [(0, FRAME_LENGTH, 44100)]
+    # a truncated header, and a free format bitrate
+    assert list(convertFlac._mp3_frames(audio_frame()[:3])) == []
+    assert list(convertFlac._mp3_frames(audio_frame(bitrate_index=0))) == []
+
+
+def test_mp3_frames_mpeg2():
+    # mpeg-2 64kbps at 22.05kHz, frames hold 576 samples
+    data = header(bitrate_index=8, version=2) + bytes(204)
+    assert list(convertFlac._mp3_frames(data)) == [(0, 208, 22050)]
+
+
+def test_xing_offset():
+    assert convertFlac._xing_offset(info_frame()) == XING
+    assert convertFlac._xing_offset(audio_frame()) is None
+
+    mono = bytearray(audio_frame(mono=True))
+    mono[21:25] = b'Xing'
+    assert convertFlac._xing_offset(mono) == 21
+
+    mpeg2 = bytearray(header(bitrate_index=8, version=2, mono=True) + bytes(204))
+    mpeg2[13:17] = b'Info'
+    assert convertFlac._xing_offset(mpeg2) == 13
+
+
+def test_crc16():
+    # the check value of crc-16/arc
+    assert convertFlac._crc16(b'123456789') == 0xBB3D
+    assert convertFlac._crc16(b'56789', convertFlac._crc16(b'1234')) == 0xBB3D
+
+
+def test_lame_info_frame():
+    frames = 10
+    delay, padding = 576, 100
+    total_samples = frames * FRAME_SAMPLES - delay - padding
+    offsets = [FRAME_LENGTH * (i + 1) for i in range(frames)]
+    stream_bytes = FRAME_LENGTH * (frames + 1)
+    music_crc = convertFlac._crc16(b''.join(audio_frame(i) for i in range(frames)))
+
+    template = info_frame(delay=delay, padding=1000)
+    frame = convertFlac._lame_info_frame(template, offsets, stream_bytes,
+                                         FRAME_SAMPLES, total_samples, music_crc)
+
+    assert len(frame) == len(template)
+    assert list(convertFlac._mp3_frames(frame)) == [(0, FRAME_LENGTH, 44100)]
+    assert struct.unpack_from('>III', frame, XING + 4) == (0xF, frames, stream_bytes)
+    toc = frame[XING + 16:XING + 116]
+    assert toc[0] == 256 * offsets[0] // stream_bytes
+    assert list(toc) == sorted(toc)
+    assert frame[LAME:LAME + 9] == b'LAME3.100'
+    assert frame[LAME + 11:LAME + 19] == bytes(8)
+    delay_padding = struct.unpack('>I', b'\0' + frame[LAME + 21:LAME + 24])[0]
+    assert delay_padding >> 12 == delay
+    assert delay_padding & 0xFFF == padding
+    assert struct.unpack_from('>IH', frame, LAME + 28) == (stream_bytes, music_crc)
+    assert struct.unpack_from('>H', frame, LAME + 34)[0] == convertFlac._crc16(
+        frame[:LAME + 34])
+
+
+def test_lame_info_frame_without_lame_tag():
+    template = bytearray(info_frame())
+    template[LAME:LAME + 4] = b'Lavf'
+    offsets = [FRAME_LENGTH, 2 * FRAME_LENGTH]
+    frame = convertFlac._lame_info_frame(bytes(template), offsets, 3 * FRAME_LENGTH,
+                                         FRAME_SAMPLES, 2 * FRAME_SAMPLES, 0)
+    assert struct.unpack_from('>III', frame, XING + 4) == (0xF, 2, 3 * FRAME_LENGTH)
+    # only the Xing fields are rewritten
+    assert frame[LAME:] == bytes(template[LAME:])